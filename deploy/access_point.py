@@ -185,7 +185,7 @@ def run(on_loop):
     print("Current AP SSID:", ap.config('essid'))
     
     scroll_text = "WIFI: "+ ap_ssid + " Password: " + ap_password + " Go to: " + ap.ifconfig()[0]       
-    neo.init_infinite_scroll(scroll_text, (35,0,2))
+    neo.init_infinite_scroll(scroll_text, (255,0,15))
     
 
     # Create a socket and bind to a port
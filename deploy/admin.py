@@ -11,6 +11,7 @@ import ntptime as ntp
 import rtcmod as rtc
 import timehelp as th
 import timesync as sync
+import civil
 import time
 
 def run():
@@ -73,11 +74,24 @@ def break_scan():
 def reset_debug():
     ntp.debug_off()
     
-def list_power():
-    hist.list_power()
+def utc_secs(t):
+    ''' Takes a time as UTC seconds or a (year, month, date, hours, minutes, seconds)
+    tuple, and returns it in seconds.'''
+    if t is None or type(t) is int: return t
+    return civil.seconds(t)
     
-def list_time_checks():
-    hist.list_time_checks()
+def list_power(since=None, until=None, limit=None):
+    ''' Lists the power ups with since <= time < until (UTC), up to limit of them.'''
+    hist.list_power(utc_secs(since), utc_secs(until), limit)
+    
+def list_time_checks(since=None, until=None, limit=None):
+    ''' Lists the time checks with since <= time < until (UTC), up to limit of them.'''
+    hist.list_time_checks(utc_secs(since), utc_secs(until), limit)
+    
+def list_events(kind=None, since=None, until=None, limit=20):
+    ''' Lists the newest events in history, of one kind (see hist.EVENT_NAMES) or all of
+    them, with since <= time < until (UTC), up to limit of them.'''
+    hist.list_recs(kind, utc_secs(since), utc_secs(until), limit, True)
     
     
     
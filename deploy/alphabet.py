@@ -66,68 +66,120 @@ font = (x_0, x_1, x_2, x_3, x_4, x_5, x_6, x_7, x_8, x_9,
         x_colon, x_plus, x_minus, x_equal,
         x_a, x_b, x_f, x_i, x_k, x_o, x_w, x_N, x_O)
 
-NPixels = 256  # Hack.  Should be a globle constan
+# Glyph Atlas
+# Rendering works from column masks: one byte per column of a glyph, where bit 0 is the
+# lowest row of the glyph.  All fonts are converted to masks once, at import.  The masks
+# of a font are kept in one bytes object, with every glyph taking up the same number of
+# bytes (the font width), along with a bytes object that gives the width of each glyph
+# (the columns up to and including the last lit one).  A 128 byte lookup table turns a
+# codepoint into a glyph number (or NO_GLYPH), so finding a glyph takes no searching.
+#
+# An atlas is the tuple (masks, widths, lookup, font_width, font_height).
+
+NO_GLYPH = 255
+
+def make_atlas(columns, nglyphs, font_width, font_height, codepoints):
+    ''' Builds an atlas.  columns(g, icol) returns the mask for a column of glyph g, and
+    codepoints gives the codepoint of each glyph, in order.'''
+    masks = bytearray(nglyphs * font_width)
+    widths = bytearray(nglyphs)
+    for g in range(nglyphs):
+        for icol in range(font_width):
+            m = columns(g, icol)
+            masks[g * font_width + icol] = m
+            if m: widths[g] = icol + 1
+    lookup = bytearray(128)
+    for i in range(128): lookup[i] = NO_GLYPH
+    for g in range(nglyphs): lookup[codepoints[g]] = g
+    return (bytes(masks), bytes(widths), bytes(lookup), font_width, font_height)
+
+def packed_5x7_column(g, icol):
+    # Most significant byte on the left, bit 0 is the bottom row.
+    return (font_5x7[g] >> ((4 - icol) * 8)) & 0x7F
+
+def packed_3x5_column(g, icol):
+    # Most significant byte on the left, bit 0 is the top row.  Flip it over.
+    b = (font_3x5[g] >> ((2 - icol) * 8)) & 0x1F
+    m = 0
+    for irow in range(5):
+        if b & (1 << irow): m |= 1 << (4 - irow)
+    return m
+
+def clock_column(g, icol):
+    # Eight entries per column, top row first.
+    bitmap = font[g]
+    m = 0
+    for irow in range(8):
+        if bitmap[icol * 8 + irow] != 0: m |= 1 << (7 - irow)
+    return m
+
+atlases = {
+    '5x7':   make_atlas(packed_5x7_column, len(font_5x7), 5, 7, range(32, 32 + len(font_5x7))),
+    '3x5':   make_atlas(packed_3x5_column, len(font_3x5), 3, 5, range(32, 32 + len(font_3x5))),
+    'clock': make_atlas(clock_column, len(font), 5, 8, [ord(c) for c in chars]),
+}
+
+def get_atlas(size):
+    if size not in atlases: raise ValueError("Unsupported font size")
+    return atlases[size]
+
+def find_glyph(atlas, c):
+    ''' Returns the glyph number of character c in the atlas, or -1 if there is none.'''
+    cp = ord(c)
+    if cp >= 128: return -1
+    g = atlas[2][cp]
+    if g == NO_GLYPH: return -1
+    return g
+
+def glyph_width(c, size='5x7'):
+    ''' Returns the number of columns that character c actually lights up.'''
+    atlas = get_atlas(size)
+    g = find_glyph(atlas, c)
+    if g < 0: return 0
+    return atlas[1][g]
+
+def blit_glyph(atlas, c, column, color, row=0):
+    ''' Draws character c into the frame buffer with its left edge at column and its
+    lowest row at row.  Only lit pixels are written.'''
+    g = find_glyph(atlas, c)
+    if g < 0: return
+    masks = atlas[0]
+    font_width = atlas[3]
+    a = g * font_width
+    for icol in range(font_width):
+        m = masks[a + icol]
+        if m: neo.blit_column(column + icol, m, color, row)
+
+def rasterize(text, size='5x7', pitch=6, row=0):
+    ''' Returns text as a strip of column masks, one byte per column, with each
+    character taking up pitch columns.  row moves the glyphs up the panel.'''
+    atlas = get_atlas(size)
+    masks = atlas[0]
+    font_width = atlas[3]
+    if font_width > pitch: font_width = pitch
+    strip = bytearray(len(text) * pitch)
+    for i in range(len(text)):
+        g = find_glyph(atlas, text[i])
+        if g < 0: continue
+        a = g * atlas[3]
+        o = i * pitch
+        for icol in range(font_width):
+            strip[o + icol] = (masks[a + icol] << row) & 0xFF
+    return strip
 
 def get_index(c):
-    ic = 0
-    while ic < len(chars):
-        if c == chars[ic]: return ic
-        ic += 1
-    return -1
-
-def render(pixels, column0, color, c):
-    '''Renders a character in the neopixel array starting at column0, using
+    return find_glyph(atlases['clock'], c)
+
+def render(column0, color, c):
+    '''Renders a character into the frame buffer starting at column0, using
     the given color.'''
-    ic = get_index(c)
-    if ic < 0: return
-    bitmap = font[ic]
-    for icolumn in range(5):
-        for irow in range(8):
-            indx = icolumn * 8 + irow
-            if bitmap[indx] != 0:
-                irealcol = column0 + icolumn
-                if irealcol % 2 == 0: j = irealcol * 8 + irow
-                else:                 j = irealcol * 8 + (7 - irow)
-                if j >=0 and j < NPixels: pixels[j] = color
+    blit_glyph(atlases['clock'], c, column0, color)
  
 def new_render(c, column, color):
-    io = ord(c) - 32
-    if io < 0 or io >= 96: return
-    glyph = font_5x7[io]
-    for icol in range(5):
-        b = (glyph >> ((4 - icol) * 8)) & 0x00FF
-        for irow in range(7):
-            if (b & 0x01) != 0: neo.set_color(icol + column, irow, color)
-            b = (b >> 1) & 0x07F
+    blit_glyph(atlases['5x7'], c, column, color)
 
 def render_char(c, column, color, size='5x7', r=0):
-    if size == '5x7':
-        font = font_5x7
-        font_width = 5
-        font_height = 7
-    elif size == '3x5':
-        font = font_3x5
-        font_width = 3
-        font_height = 5
-    else:
-        raise ValueError("Unsupported font size")
-    
-    io = ord(c) - 32
-    if io < 0 or io >= len(font):
-        return
-    
-    glyph = font[io]
-    for icol in range(font_width):
-        b = (glyph >> (font_width - 1 - icol) * 8) & 0x00FF  
-        for irow in range(font_height):
-            if (b & 0x01) != 0:
-                display_row = irow+r
-                if size =='3x5': display_row = font_height-1 - irow +r
-                neo.set_color(icol + column, display_row, color)
-            if size == '5x7':
-                b = (b >> 1) & 0x07F
-            elif size == '3x5':
-                b = (b >> 1) & 0x05F
+    blit_glyph(get_atlas(size), c, column, color, r)
 
 def show_char(c, column, color, size ='5x7'):
     neo.solid(neo.c_black)
@@ -137,14 +189,14 @@ def show_char(c, column, color, size ='5x7'):
 def show_test():
     line = ''' ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789.,"'?!@_*#$%&()+-/:;<=>[\]^`{|}~'''
     for c in line:
-        show_char(c,0,(15,0,55))
+        show_char(c,0,(60,0,220))
         time.sleep(0.65)
         
 def short_test(font = '5x7'):
     line = ''' ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789.,"'?!@_*#$%&()+-/:;<=>[\]^`{|}~'''
     for c in line:
         neo.solid(neo.c_black)
-        render_char(c,0, (22,22,0), font)
+        render_char(c,0, (220,220,0), font)
         neo.show()
         time.sleep(.35)
 
@@ -157,11 +209,11 @@ def hello_world(font = '3x5'):
         font_width = 3
         
     neo.solid(neo.c_black)
-    render_char('H',0, (22,22,0), font)
-    render_char('e',font_width, (22,0,22), font)
-    render_char('l',font_width*2, (0,22,22), font)
-    render_char('l',font_width*3, (0,0,22), font)
-    render_char('o',font_width*4, (22,0,0), font)
+    render_char('H',0, (220,220,0), font)
+    render_char('e',font_width, (220,0,220), font)
+    render_char('l',font_width*2, (0,220,220), font)
+    render_char('l',font_width*3, (0,0,220), font)
+    render_char('o',font_width*4, (220,0,0), font)
     neo.show()
 
 
@@ -0,0 +1,130 @@
+# civil.py -- Integer civil calendar
+
+# Converts between dates and day or second counts with integer math only, so the tick
+# path never has to call time.mktime() or time.localtime().  The day counting follows
+# Howard Hinnant's days_from_civil / civil_from_days (proleptic Gregorian, years made to
+# start in March so the leap day falls at the end), and weekdays of a date use Sakamoto's
+# method.
+#
+# Counts are from the same epoch as time.mktime() on this platform: 1/1/2000 on
+# micropython, 1/1/1970 on a PC.  Times use the micropython 8-tuple:
+# (year, month, date, hour, minute, second, dow, doy), with Monday = 0 and doy from 1.
+
+import time
+
+def days_from_civil(y, m, d):
+    ''' Returns the number of days from 1/1/1970 to a date.'''
+    if m <= 2: y -= 1
+    era = y // 400
+    yoe = y - era * 400                                     # [0, 399]
+    if m > 2: mp = m - 3
+    else: mp = m + 9
+    doy = (153 * mp + 2) // 5 + d - 1                       # [0, 365], from March 1st
+    doe = yoe * 365 + yoe // 4 - yoe // 100 + doy           # [0, 146096]
+    return era * 146097 + doe - 719468
+
+def civil_from_days(z):
+    ''' Returns (year, month, date) for a number of days from 1/1/1970.'''
+    z += 719468
+    era = z // 146097
+    doe = z - era * 146097
+    yoe = (doe - doe // 1460 + doe // 36524 - doe // 146096) // 365
+    doy = doe - (365 * yoe + yoe // 4 - yoe // 100)
+    mp = (5 * doy + 2) // 153
+    d = doy - (153 * mp + 2) // 5 + 1
+    if mp < 10: m = mp + 3
+    else: m = mp - 9
+    y = yoe + era * 400
+    if m <= 2: y += 1
+    return (y, m, d)
+
+EPOCH_YEAR = time.gmtime(0)[0]
+EPOCH_DAYS = days_from_civil(EPOCH_YEAR, 1, 1)   # Platform epoch, in days from 1/1/1970
+
+sakamoto = (0, 3, 2, 5, 0, 3, 5, 1, 4, 6, 2, 4)
+
+def weekday_of(y, m, d):
+    ''' Returns the day-of-week (0=Monday) of a date.'''
+    if m < 3: y -= 1
+    return (y + y // 4 - y // 100 + y // 400 + sakamoto[m - 1] + d + 6) % 7
+
+def weekday(days):
+    ''' Returns the day-of-week (0=Monday) of a day count from the epoch.'''
+    return (days + EPOCH_DAYS + 3) % 7     # 1/1/1970 was a Thursday.
+
+def is_leap(year):
+    return year % 4 == 0 and (year % 100 != 0 or year % 400 == 0)
+
+def day_of_year(y, m, d):
+    ''' Returns the day of the year, starting with 1 for January 1st.'''
+    return days_from_civil(y, m, d) - days_from_civil(y, 1, 1) + 1
+
+def days_in_month(y, m):
+    if m == 2: return 29 if is_leap(y) else 28
+    return (31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31)[m - 1]
+
+def days(y, m, d):
+    ''' Returns the number of days from the epoch to a date.'''
+    return days_from_civil(y, m, d) - EPOCH_DAYS
+
+def seconds(t):
+    ''' Returns seconds from the epoch for a time tuple, like time.mktime().  Only the
+    first six fields are used.'''
+    return (days_from_civil(t[0], t[1], t[2]) - EPOCH_DAYS) * 86400 + t[3] * 3600 + t[4] * 60 + t[5]
+
+def to_tuple(secs):
+    ''' Returns the time 8-tuple for seconds from the epoch, like time.gmtime().'''
+    z = secs // 86400
+    s = secs - z * 86400
+    y, m, d = civil_from_days(z + EPOCH_DAYS)
+    return (y, m, d, s // 3600, s // 60 % 60, s % 60, weekday(z), day_of_year(y, m, d))
+
+def check(first_year=1970, last_year=2100):
+    ''' Checks every day from first_year to last_year against time.gmtime().  Years before
+    the platform's epoch are skipped.  Returns the number of mismatches.'''
+    if first_year < EPOCH_YEAR: first_year = EPOCH_YEAR
+    bad = 0
+    z = days(first_year, 1, 1)
+    zend = days(last_year + 1, 1, 1)
+    while z < zend:
+        secs = z * 86400 + 45296     # 12:34:56
+        expect = tuple(time.gmtime(secs))[:8]
+        got = to_tuple(secs)
+        if got != expect or seconds(expect) != secs or weekday_of(got[0], got[1], got[2]) != expect[6]:
+            print("Calendar mismatch: ", expect, got)
+            bad += 1
+        z += 1
+    return bad
+
+def bench(n=1000):
+    ''' Times the old calendar calls against the ones here, in microseconds per call.'''
+    if hasattr(time, "ticks_us"):
+        now = time.ticks_us
+        diff = time.ticks_diff
+    else:
+        now = lambda: int(time.perf_counter() * 1000000)
+        diff = lambda a, b: a - b
+    t = (2024, 7, 4, 19, 30, 5, 3, 186)
+    tm = t + (0,) * (len(tuple(time.gmtime(0))) - 8)   # A PC wants a 9-tuple
+    tref = (1996, 1, 1, 0, 0, 0, 0, 0) + tm[8:]
+    def mktime_day_of_week():
+        # How timehelp.day_of_week() used to do it.
+        return int((time.mktime(tm) - time.mktime(tref)) / 86400) % 7
+    results = {}
+    def run(name, f):
+        t0 = now()
+        for i in range(n): f()
+        results[name] = diff(now(), t0) / n
+    run("mktime", lambda: time.mktime(tm))
+    run("seconds", lambda: seconds(t))
+    run("mktime x2 day_of_week", mktime_day_of_week)
+    run("weekday_of", lambda: weekday_of(t[0], t[1], t[2]))
+    run("mktime+localtime", lambda: time.localtime(time.mktime(tm) - 7 * 3600))
+    run("seconds+to_tuple", lambda: to_tuple(seconds(t) - 7 * 3600))
+    for name in results: print("%-24s %8.1f us" % (name, results[name]))
+    # A tick used to do a mktime for the rtc reading, a mktime/localtime round trip for
+    # the offset, and day_of_week for critical times and again for daylight savings.
+    old = results["mktime"] + results["mktime+localtime"] + 2 * results["mktime x2 day_of_week"]
+    new = results["seconds"] + results["weekday_of"]
+    print("Saved per tick: %.1f us" % (old - new))
+    return results
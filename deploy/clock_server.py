@@ -10,6 +10,9 @@ import ure
 import gc
 import log
 import rtcmod as rtc
+import neo
+import timehelp as th
+import settings
     
 html_page_head = """
 <!DOCTYPE html>
@@ -71,6 +74,25 @@ html_page_body = """
         </div>
         <button id="sendMessageButton" onclick="sendMessage()">Send</button>
     </div>
+    <div id="timeZone" class="settings-box">
+        <h2>Time Zone</h2>
+        <input list="timeZoneList" id="timeZoneText" size="40" value="{{timezone}}">
+        <datalist id="timeZoneList">
+            <option value="PST8PDT,M3.2.0,M11.1.0">US Pacific</option>
+            <option value="MST7MDT,M3.2.0,M11.1.0">US Mountain</option>
+            <option value="MST7">Arizona</option>
+            <option value="CST6CDT,M3.2.0,M11.1.0">US Central</option>
+            <option value="EST5EDT,M3.2.0,M11.1.0">US Eastern</option>
+            <option value="AKST9AKDT,M3.2.0,M11.1.0">Alaska</option>
+            <option value="HST10">Hawaii</option>
+            <option value="GMT0BST,M3.5.0/1,M10.5.0">UK</option>
+            <option value="CET-1CEST,M3.5.0,M10.5.0/3">Central Europe</option>
+            <option value="AEST-10AEDT,M10.1.0,M4.1.0/3">Sydney</option>
+            <option value="UTC0">UTC</option>
+        </datalist>
+        <button onclick="setTimeZone()">Set</button>
+        <span id="timeZoneResult"></span>
+    </div>
     <div id="deviceInfo" class="settings-box">
         <h2>Device Info</h2>
         <button onclick="getDeviceInfo()">Get Device Info</button><br><br>
@@ -100,6 +122,10 @@ html_page_script = """
 
 """
 
+def html_escape(s):
+    ''' Makes a string safe to put in html text or a quoted attribute.'''
+    return s.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;").replace('"', "&quot;").replace("'", "&#39;")
+
 def rgb_to_hex(rgb):
     return "#{:02x}{:02x}{:02x}".format(rgb[0], rgb[1], rgb[2])
 
@@ -133,7 +159,7 @@ cors_headers += b'Access-Control-Allow-Methods: POST\n'
 cors_headers += b'Access-Control-Allow-Headers: Content-Type\n'
 
 
-def start_server_loop(get_clock_values, update_colors, play_rainbow, send_message, on_loop, seconds_style):
+def start_server_loop(get_clock_values, update_colors, play_rainbow, send_message, on_loop, seconds_style, set_timezone):
     addr = socket.getaddrinfo('0.0.0.0', 80)[0][-1]
     s = socket.socket()
     s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)  # Allow reusing the address
@@ -196,10 +222,13 @@ def start_server_loop(get_clock_values, update_colors, play_rainbow, send_messag
                 handle_seconds_style(conn, seconds_style)
                 continue
             elif b"POST /get_time_check_records" in request:
-                handle_get_time_check_records(conn)
+                handle_get_time_check_records(request, conn)
                 continue
             elif b"POST /get_power_records" in request:
-                handle_get_power_records(conn)
+                handle_get_power_records(request, conn)
+                continue
+            elif b"POST /get_history" in request:
+                handle_get_history(request, conn)
                 continue
             elif b"POST /get_error_log" in request:
                 handle_get_error_log(conn)
@@ -207,6 +236,9 @@ def start_server_loop(get_clock_values, update_colors, play_rainbow, send_messag
             elif b"POST /send_message" in request:
                 handle_send_message(request, send_message, conn)
                 continue
+            elif b"POST /set_timezone" in request:
+                handle_set_timezone(request, set_timezone, conn)
+                continue
             elif b"POST /get_device_info" in request:
                 handle_get_device_info(conn, wlan)
                 continue
@@ -223,6 +255,7 @@ def start_server_loop(get_clock_values, update_colors, play_rainbow, send_messag
                 ("{{m}}", time_object[1]),
                 ("{{s}}", time_object[2]),
                 ("{{am}}", time_object[3]),
+                ("{{timezone}}", html_escape(th.get_timezone())),
             ]
 
             # Perform the replacements
@@ -247,6 +280,18 @@ def start_server_loop(get_clock_values, update_colors, play_rainbow, send_messag
         on_loop()
         time.sleep(0.01)
         
+SEND_CHUNK = 1024
+
+def send_lines(conn, lines):
+    ''' Sends the lines from a generator, SEND_CHUNK bytes or so at a time.'''
+    chunk = ""
+    for line in lines:
+        chunk += line
+        if len(chunk) >= SEND_CHUNK:
+            send_data(conn, chunk.encode('utf-8'))
+            chunk = ""
+    if chunk: send_data(conn, chunk.encode('utf-8'))
+
 def send_data(conn, data):
     while data:
         try:
@@ -375,18 +420,46 @@ def handle_get_error_log(conn):
         send_data(conn, chunk)
     conn.close()
     
-def handle_get_time_check_records(conn):
-    time_records = history.list_time_checks()
-    print("time_records: ", time_records)
+HISTORY_LIMIT = 64      # Most history lines sent for one request, unless it asks for fewer
+
+def history_query(request):
+    ''' Returns (kind, since, until, limit) from the query string of a history request.  since
+    and until are UTC seconds, as the clock counts them.  kind is one of the history
+    event kinds, or None for all of them.'''
+    path = request.split(b'\r\n')[0].split(b' ')[1].decode('utf-8')
+    since = None
+    until = None
+    limit = HISTORY_LIMIT
+    kind = None
+    if '?' in path:
+        for param in path.split('?', 1)[1].split('&'):
+            if '=' not in param: continue
+            key, value = param.split('=', 1)
+            try:
+                if key == "since": since = int(value)
+                elif key == "until": until = int(value)
+                elif key == "limit": limit = min(int(value), HISTORY_LIMIT)
+                elif key == "kind": kind = int(value)
+            except ValueError:
+                pass
+    return kind, since, until, limit
+
+def handle_get_time_check_records(request, conn):
+    kind, since, until, limit = history_query(request)
     send_data(conn, b'HTTP/1.1 200 OK\n\n')
-    send_data(conn, time_records.encode('utf-8'))
+    send_lines(conn, history.rec_lines(history.EV_TIME_CHECK, since, until, limit, True))
     conn.close()
 
-def handle_get_power_records(conn):
-    power_records = history.list_power()
-    print("power records: ", power_records)
+def handle_get_power_records(request, conn):
+    kind, since, until, limit = history_query(request)
     send_data(conn, b'HTTP/1.1 200 OK\n\n')
-    send_data(conn, power_records.encode('utf-8'))
+    send_lines(conn, history.rec_lines(history.EV_POWER_UP, since, until, limit, True))
+    conn.close()
+
+def handle_get_history(request, conn):
+    kind, since, until, limit = history_query(request)
+    send_data(conn, b'HTTP/1.1 200 OK\n\n')
+    send_lines(conn, history.rec_lines(kind, since, until, limit, True))
     conn.close()
 
 def handle_send_message(request, send_message, conn):
@@ -411,6 +484,24 @@ def handle_send_message(request, send_message, conn):
     send_data(conn, b'HTTP/1.1 200 OK\n\n')
     conn.close()
 
+def handle_set_timezone(request, set_timezone, conn):
+    path = request.split(b'\r\n')[0].split(b' ')[1].decode('utf-8')
+    query_string = path[len("/set_timezone?"):]
+    decoded_query_string = ure.sub('%[0-9a-fA-F][0-9a-fA-F]', lambda m: chr(int(m.group(0)[1:], 16)), query_string)
+    tz = ""
+    for param in decoded_query_string.split('&'):
+        if '=' not in param: continue
+        key, value = param.split('=', 1)
+        if key == "tz": tz = value
+
+    if tz and set_timezone(tz):
+        send_data(conn, b'HTTP/1.1 200 OK\n\n')
+        send_data(conn, b'Time zone set')
+    else:
+        send_data(conn, b'HTTP/1.1 400 Bad Request\n\n')
+        send_data(conn, b'Not a valid POSIX TZ string')
+    conn.close()
+
 def handle_get_device_info(conn, wlan):
     temperature = machine.ADC(4).read_u16() * (3.3 / 65535.0 * 100)
     led = machine.Pin(25, machine.Pin.OUT)
@@ -433,13 +524,40 @@ def handle_get_device_info(conn, wlan):
 
     signal_strength_category = classify_signal_strength(wifi_info["Signal Strength (RSSI)"])
     response_text += f"  Signal Strength Category: {signal_strength_category}\r\n"
+    response_text += f"\r\nTime Zone: {th.get_timezone()}\r\n"
+
+    stats = neo.get_render_stats()
+    response_text += "\r\nDisplay:\r\n"
+    response_text += f"  Frames Shown: {stats['frames_shown']}\r\n"
+    response_text += f"  Frames Skipped: {stats['frames_skipped']}\r\n"
+    response_text += f"  Pixels Touched: {stats['pixels_touched']}\r\n"
+    response_text += f"  Minute Layer Hits: {stats['layer_hits']}, Misses: {stats['layer_misses']}\r\n"
+    frames = neo.get_frame_stats()
+    response_text += f"  Ticks: {frames['ticks']}, Deadline Misses: {frames['misses']}\r\n"
+    response_text += f"  Lateness: avg {frames['late_avg_ms']:.1f} ms, max {frames['late_max_ms']} ms, jitter {frames['jitter_ms']:.1f} ms\r\n"
+    response_text += f"  Tick Time: avg {frames['work_avg_us']} us, max {frames['work_max_us']} us\r\n"
+    sync = rtc.get_sync_stats()
+    response_text += f"  RTC Anchor: {sync['state']}, Reads: {sync['reads']}, Corrections: {sync['corrections']}\r\n"
+    bus = rtc.get_bus_stats()
+    response_text += f"\r\nI2C Bus ({bus['freq'] // 1000} kHz):\r\n"
+    for name in rtc.BUS_NAMES:
+        dev = bus[name]
+        response_text += f"  {name}: {dev['transactions']} transactions, {dev['bytes']} bytes, {dev['us'] // 1000} ms\r\n"
+    cache = rtc.get_eeprom_stats()
+    response_text += f"  EEPROM Cache: {cache['dirty_pages']} dirty pages, {cache['page_writes']} page writes, {cache['write_polls']} busy polls\r\n"
+    saves = settings.get_stats()
+    response_text += "\r\nSettings:\r\n"
+    response_text += f"  Saving: {saves['changes']} changes, {saves['commits']} saves, {saves['field_writes']} fields written\r\n"
+    store = history.get_settings_stats()
+    response_text += f"  Store: {store['settings']} settings, {store['appends']} records written, sequence {store['seq']}\r\n"
     
-    response_text += "\r\nMemory Dump:\r\n" + rtc.dump_eeprom(0, 2048)
+    response_text += "\r\nMemory Dump:\r\n"
 
     print("get device info: ", response_text)
     
     send_data(conn, b'HTTP/1.1 200 OK\n\n')
     send_data(conn, response_text.encode('utf-8'))
+    send_lines(conn, rtc.dump_lines(0, 2048))
     conn.close()
 
 
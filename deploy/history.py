@@ -3,22 +3,47 @@
 
 # Here we use EEPROM to record when the clock
 # was reset to a known time.  Also records the number
-# of main power cycles that occurr.
+# of main power cycles that occurr, and a few other
+# events: how far off the clock was at an ntp check and
+# how long the request took, crashes, and brightness
+# changes.
 
-# This is done as a list of records.  Each record is
-# 8 bytes, 4 bytes for a count, and 4 bytes for a
-# unix time value (in UTC).
+# This is done as one log of events over pages 2 to 36,
+# which used to hold two catalogs of 8 byte records (a
+# 4 byte count and a 4 byte unix time).  Each page starts
+# with a 7 byte header: a one byte sequence number, the
+# unix time (UTC) the page starts at, and a crc16 of the
+# page.  The other 25 bytes are events, each a varint of
+# the seconds since the one before, shifted up 3 bits over
+# the event kind, and then a varint value for the kinds
+# that carry one.  Most events take 2 or 3 bytes, so the
+# log holds about 300 where the catalogs held 64 each.
 
-# Because of the way that the eeprom works, we want
-# to make our records fit an eeprom "page" which is 32
-# bytes.  So, we choose 64 records in the database,
-# where 4 records fit in a page, so 16 pages are used
-# for each history catalog: one for power ups, and one
-# for clock checks.
+# All kinds share the log, so old power ups and time
+# checks get pushed out by the rest.  The settings store
+# keeps their totals and the time of the last of each
+# under KEY_LAST_EVENTS, so the last ones are always
+# known, and the count of each one in the log is worked
+# back from the totals when the log is loaded.
+
+# The log is a ring of pages.  The newest page (the head)
+# is found by its sequence number the first time it is
+# needed, and a copy of it kept here, so adding an event
+# rewrites just that page, in the eeprom cache.  A page
+# that was torn by a power loss fails its crc and is
+# skipped.  Pages go forward in time around the ring, so
+# events() finds the pages for a time range with a binary
+# search on their base times.
+
+# The settings store keeps the version of the log under
+# KEY_HISTORY.  Until that is there, the pages are taken
+# to hold the old catalogs, which are checked and moved
+# into the log once.
 
 import struct
 import rtcmod as rt
 import time
+from collections import namedtuple
 
 PAGE_SIZE     = 32
 REC_SIZE      =  8 
@@ -26,12 +51,43 @@ RECS_PER_PAGE = int(PAGE_SIZE / REC_SIZE)   # This must be an interger
 NPAGES        = 16
 NRECS         = NPAGES * RECS_PER_PAGE  # Total number of records before rollover
 PAGE_CLK_ID   =  1                      # Page for Clock ID
-PAGE_PWR_CYC  =  2                      # First Page for Power cycle records
-PAGE_TIME_CHK = 20                      # First Page for Time Check records
-PAGE_BRIGHT   = 37						# Page for saving brightness level and render state
-PAGE_COLORS   = 38
+PAGE_PWR_CYC  =  2                      # First Page of the old Power cycle records
+PAGE_TIME_CHK = 20                      # First Page of the old Time Check records
+PAGE_BRIGHT   = 37						# Old settings pages, only read to move them
+PAGE_COLORS   = 38                      # into the settings store.
 PAGE_WIFI_SSID	  = 41						
 PAGE_WIFI_PW	  = 42						
+PAGE_TIMEZONE = 43                      # Two pages for the POSIX TZ string
+PAGE_SETTINGS = 64                      # First page of the settings store
+SETTINGS_PAGES = 64
+
+HIST_PAGE0    =  2                      # First page of the event log
+HIST_PAGES    = 35                      # Pages 2 to 36
+HIST_FORMAT   = "<BL"                   # Sequence, base time
+HIST_CRC      =  5                      # Where the page crc goes
+HIST_HEADER   =  7
+HIST_VERSION  = 2
+LAST_FORMAT   = "<LLLL"                 # Power ups and the last one's time, the same for time checks
+
+EV_POWER_UP     = 1                     # The clock was powered up.
+EV_TIME_CHECK   = 2                     # The time was set, from ntp or by hand.
+EV_NTP_OFFSET   = 3                     # Clock minus ntp time, in seconds, before setting it.
+EV_SYNC_LATENCY = 4                     # How long the ntp request took, in ms.
+EV_CRASH        = 5                     # The clock crashed.  1 if it was fatal.
+EV_BRIGHTNESS   = 6                     # The brightness was changed, times 1000.
+EVENT_NAMES = ("", "power up", "time check", "ntp offset", "sync latency", "crash", "brightness", "")
+HAS_VALUE = (False, False, False, True, True, True, True, False)
+Event = namedtuple("Event", ("kind", "t", "value", "count"))
+
+hist_page = None                        # Head page of the log, -1 if empty, None if not loaded
+hist_seq = 0                            # Sequence number of the head page
+hist_buf = bytearray(PAGE_SIZE)         # Copy of the head page
+hist_used = 0                           # Bytes used in the head page
+hist_last_t = 0                         # Time of the last event
+hist_totals = [0, 0]                    # Power ups and time checks, up to the last event
+page_totals = [None] * HIST_PAGES       # Power ups and time checks before each page
+last_events = {}                        # Kind -> (time, value, count) of its last event
+event_buf = bytearray(PAGE_SIZE)
 
 
 def wipe_eeprom(clock_id = b'default'):
@@ -41,6 +97,9 @@ def wipe_eeprom(clock_id = b'default'):
         rt.write_eeprom(i*32, buf)
     rt.write_eeprom(0, b'epicclock')
     write_clock_id(clock_id)
+    rt.wait_idle()
+    hist_reset()
+    kv_reset()
     
 def init_eeprom():
     ''' Checks to see if the eeprom has been initized. If not
@@ -65,11 +124,168 @@ def read_clock_id():
         s += chr(b)
     return s
 
+# Settings Store
+# The settings are kept as records in a log over SETTINGS_PAGES pages.  A
+# record is an 8 byte header (key, length, crc, sequence number) and the
+# value, padded out to whole pages, so most settings take one page.  A
+# changed setting is appended as a new record at the head of the log,
+# and the copy with the highest sequence number wins.  The crc covers the
+# header and value, so a record that was only partly written is ignored,
+# and the copy before it is used instead.
+#
+# The log is scanned once, on first use, to build kv_index (key -> page,
+# length, sequence), so reading a setting is a lookup in the eeprom cache.
+# The head goes round and round the pages, so they wear evenly.  Pages
+# with old copies are simply written over when the head comes round; the
+# head steps over any page that still has a live record, so a live record
+# is never written over.
+#
+# Settings used to live at fixed pages (PAGE_BRIGHT and so on).  If the
+# store is empty when it's first scanned, what is in the old pages is
+# moved into it.
+
+KV_HEADER = 8                           # key, length, crc, sequence: "<BBHL"
+KV_MAX = 255
+
+KEY_BRIGHTNESS   = 1
+KEY_RENDER_STYLE = 2
+KEY_COLORS       = 3
+KEY_WIFI_SSID    = 4
+KEY_WIFI_PW      = 5
+KEY_TIMEZONE     = 6
+KEY_HISTORY      = 7                    # Version of the event log, once it has been set up
+KEY_LAST_EVENTS  = 8                    # Totals and last times of power ups and time checks
+
+kv_index = None
+kv_head = 0                             # Page (in the store) for the next record
+kv_seq = 0                              # Sequence number of the last record
+kv_appends = 0
+kv_skips = 0                            # Live records the head stepped over
+
+crc_table = None
+
+def crc16(data, crc=0xFFFF):
+    ''' CRC-16/CCITT of some bytes.'''
+    global crc_table
+    if crc_table is None:
+        crc_table = []
+        for i in range(256):
+            c = i << 8
+            for j in range(8):
+                if c & 0x8000: c = ((c << 1) ^ 0x1021) & 0xFFFF
+                else: c = (c << 1) & 0xFFFF
+            crc_table.append(c)
+    for b in data: crc = ((crc << 8) & 0xFFFF) ^ crc_table[(crc >> 8) ^ b]
+    return crc
+
+def kv_pages(length):
+    return (KV_HEADER + length + PAGE_SIZE - 1) // PAGE_SIZE
+
+def kv_record_at(page):
+    ''' Returns (key, length, seq) for a good record starting at a page of
+    the store, or None.'''
+    addr = (PAGE_SETTINGS + page) * PAGE_SIZE
+    key, length, crc, seq = struct.unpack_from("<BBHL", rt.peek_eeprom(addr, KV_HEADER))
+    if key == 0 or key == 0xFF or page + kv_pages(length) > SETTINGS_PAGES: return None
+    value = rt.peek_eeprom(addr + KV_HEADER, length)
+    if crc16(value, crc16(struct.pack("<BBL", key, length, seq))) != crc: return None
+    return key, length, seq
+
+def kv_reset():
+    global kv_index
+    kv_index = None
+
+def kv_load():
+    ''' Builds the index by scanning the store, if it hasn't been done.'''
+    global kv_index, kv_head, kv_seq
+    if kv_index is not None: return
+    kv_index = {}
+    kv_head = 0
+    kv_seq = 0
+    page = 0
+    while page < SETTINGS_PAGES:
+        rec = kv_record_at(page)
+        if rec is None:
+            page += 1
+            continue
+        key, length, seq = rec
+        if key not in kv_index or seq > kv_index[key][2]: kv_index[key] = (page, length, seq)
+        n = kv_pages(length)
+        if seq > kv_seq:
+            kv_seq = seq
+            kv_head = (page + n) % SETTINGS_PAGES
+        page += n
+    if not kv_index: migrate_settings()
+
+def kv_get(key, default=None):
+    ''' Returns the value of a setting as bytes, or default.'''
+    kv_load()
+    if key not in kv_index: return default
+    page, length, seq = kv_index[key]
+    return rt.read_eeprom((PAGE_SETTINGS + page) * PAGE_SIZE + KV_HEADER, length)
+
+def kv_put(key, value):
+    ''' Saves a setting, by appending a record to the store.'''
+    global kv_head, kv_seq, kv_appends
+    kv_load()
+    value = bytes(value)
+    if len(value) > KV_MAX: raise ValueError("setting too long")
+    if kv_get(key) == value: return
+    n = kv_pages(len(value))
+    page = kv_room(n)
+    kv_seq += 1
+    buf = bytearray(n * PAGE_SIZE)
+    crc = crc16(value, crc16(struct.pack("<BBL", key, len(value), kv_seq)))
+    struct.pack_into("<BBHL", buf, 0, key, len(value), crc, kv_seq)
+    buf[KV_HEADER:KV_HEADER + len(value)] = value
+    rt.write_eeprom((PAGE_SETTINGS + page) * PAGE_SIZE, buf)
+    kv_index[key] = (page, len(value), kv_seq)
+    kv_head = (page + n) % SETTINGS_PAGES
+    kv_appends += 1
+
+def kv_room(n):
+    ''' Returns the page at or after the head where n pages can be written
+    without touching a live record.'''
+    global kv_head, kv_skips
+    for tries in range(2 * SETTINGS_PAGES):
+        if kv_head + n > SETTINGS_PAGES: kv_head = 0
+        end = kv_head + n
+        clear = True
+        for page, length, seq in kv_index.values():
+            if page < end and page + kv_pages(length) > kv_head:
+                kv_head = page + kv_pages(length)
+                kv_skips += 1
+                clear = False
+                break
+        if clear: return kv_head
+    raise OSError("settings store is full")
+
+def migrate_settings():
+    ''' Moves settings from the old fixed pages into the store.'''
+    def nonzero(b):
+        for x in b:
+            if x != 0: return True
+        return False
+    bright = rt.read_eeprom(PAGE_BRIGHT * PAGE_SIZE, 4)
+    if nonzero(bright[0:2]): kv_put(KEY_BRIGHTNESS, bright[0:2])
+    if nonzero(bright[3:4]): kv_put(KEY_RENDER_STYLE, bright[3:4])
+    colors = rt.read_eeprom(PAGE_COLORS * PAGE_SIZE, 16)
+    if nonzero(colors): kv_put(KEY_COLORS, colors)
+    for key, page, size in ((KEY_WIFI_SSID, PAGE_WIFI_SSID, PAGE_SIZE), (KEY_WIFI_PW, PAGE_WIFI_PW, PAGE_SIZE), (KEY_TIMEZONE, PAGE_TIMEZONE, 2 * PAGE_SIZE)):
+        b = rt.read_eeprom(page * PAGE_SIZE, size)
+        n = b.find(b'\x00')
+        if n < 0: n = size
+        if n > 0: kv_put(key, b[:n])
+
+def get_settings_stats():
+    kv_load()
+    return {"settings": len(kv_index), "appends": kv_appends, "skips": kv_skips, "seq": kv_seq}
+
 def write_render_style(render_style):
-    rt.write_eeprom(PAGE_BRIGHT * PAGE_SIZE + 3, [render_style])
+    kv_put(KEY_RENDER_STYLE, bytes([render_style]))
     
 def read_render_style():
-    return rt.read_eeprom(PAGE_BRIGHT*PAGE_SIZE+3, 1)[0]
+    return kv_get(KEY_RENDER_STYLE, b'\x00')[0]
     
 def write_brightness(brightness):
     ''' Writes the brightness into eeprom as 2 bytes'''
@@ -77,11 +293,11 @@ def write_brightness(brightness):
     b1 = intBrightness & 0x0ff
     b2 = intBrightness >> 8 & 0x0ff
     b = bytearray([b1,b2])
-    rt.write_eeprom(PAGE_BRIGHT*PAGE_SIZE, b)
+    kv_put(KEY_BRIGHTNESS, b)
     
 def read_brightness():
     ''' reads the brightness into eeprom as 2 bytes'''
-    bb = rt.read_eeprom(PAGE_BRIGHT*PAGE_SIZE, 2)
+    bb = kv_get(KEY_BRIGHTNESS, bytes(2))
     intBrightness = (bb[1] <<8) | bb[0]
     brightness = intBrightness/1000.0
     if brightness <.0001: brightness = .03
@@ -95,11 +311,11 @@ def write_colors(digit_color, digit_state, colon_color, colon_state, seconds_col
     ar, ag, ab = am_color
     
     b = bytearray([dr, dg, db, digit_state, cr, cg, cb, colon_state, sr, sg, sb, seconds_state, ar, ag, ab, am_state])
-    rt.write_eeprom(PAGE_COLORS * PAGE_SIZE, b)
+    kv_put(KEY_COLORS, b)
     
 def read_colors():
     '''reads the colors and their transitional states'''
-    dr, dg, db, digit_state, cr, cg, cb, colon_state, sr, sg, sb, seconds_state, ar, ag, ab, am_state = rt.read_eeprom(PAGE_COLORS * PAGE_SIZE, 16)
+    dr, dg, db, digit_state, cr, cg, cb, colon_state, sr, sg, sb, seconds_state, ar, ag, ab, am_state = kv_get(KEY_COLORS, bytes(16))
     
     #if all zeros then initilize to this color
     if dr == dg == db == cr == cg == cb == sr == sg == sb == ar == ag == ab == 0:
@@ -121,7 +337,6 @@ def read_colors():
 
 def write_wifi(ssid, pw):
     ''' Writes WiFi SSID and password into EEPROM.'''
-    empty_bytes = bytes([0] * PAGE_SIZE)
     if type(ssid) is str:
         ssid = bytes(ssid, 'utf-8')[:PAGE_SIZE]
     else:
@@ -132,18 +347,14 @@ def write_wifi(ssid, pw):
     else:
         pw = pw[:PAGE_SIZE]
     
-    rt.write_eeprom(PAGE_WIFI_SSID * PAGE_SIZE, empty_bytes)
-    rt.write_eeprom(PAGE_WIFI_PW * PAGE_SIZE, empty_bytes)
-    
-    rt.write_eeprom(PAGE_WIFI_SSID * PAGE_SIZE, ssid)
-    rt.write_eeprom(PAGE_WIFI_PW * PAGE_SIZE, pw)
+    kv_put(KEY_WIFI_SSID, ssid)
+    kv_put(KEY_WIFI_PW, pw)
+    rt.wait_idle()  # Don't risk losing these to a reset.
 
 def read_wifi():
     ''' Reads WiFi SSID and password from EEPROM.'''
-    wifi_data = rt.read_eeprom(PAGE_WIFI_SSID * PAGE_SIZE, PAGE_SIZE*2)
-    
-    ssid_bytes = wifi_data[:PAGE_SIZE]
-    pw_bytes = wifi_data[PAGE_SIZE:]
+    ssid_bytes = kv_get(KEY_WIFI_SSID, b'')
+    pw_bytes = kv_get(KEY_WIFI_PW, b'')
     print("ssid_bytes:", ssid_bytes)
     print("pw_bytes", pw_bytes)
     try:
@@ -156,79 +367,324 @@ def read_wifi():
 
     return ssid, pw
 
-def get_last(page0):
-    ''' Returns the last best record as a 4-tuple or None.
-    The 4-tuple is (page_num, index, count, unix-time)'''
-    ibest = (0, 0, 0, 0)
-    for i in range(NPAGES):
-        buf = rt.read_eeprom((page0 + i)*PAGE_SIZE, PAGE_SIZE)
-        for j in range(RECS_PER_PAGE):
-            c, t = struct.unpack_from("LL", buf, j*8)
-            if c > 0:
-                if c > ibest[2]: ibest = (i, j, c ,t)
-    return ibest
-
-def write_record(ipage, index, buf):
-    ''' Write one record into the eeprom at the given page and index.'''
-    rt.write_eeprom(ipage * PAGE_SIZE + index * REC_SIZE, buf)
+def write_timezone(tz):
+    ''' Writes the POSIX TZ string into EEPROM.'''
+    kv_put(KEY_TIMEZONE, bytes(tz, 'ascii')[:2*PAGE_SIZE - 1])
+
+def read_timezone():
+    ''' Reads the POSIX TZ string from EEPROM.  Returns "" if none has been saved.'''
+    bb = kv_get(KEY_TIMEZONE, b'')
+    s = ""
+    for b in bb:
+        if b == 0 or b > 127: return s
+        s += chr(b)
+    return s
+
+def hist_page_at(i):
+    ''' Returns page i of the event log as a memoryview, or None if it doesn't check.'''
+    page = rt.peek_eeprom((HIST_PAGE0 + i) * PAGE_SIZE, PAGE_SIZE)
+    crc = struct.unpack_from("<H", page, HIST_CRC)[0]
+    if page[0] == 0 or crc16(page[HIST_HEADER:], crc16(page[:HIST_CRC])) != crc: return None
+    return page
+
+def put_varint(buf, i, n):
+    while n >= 0x80:
+        buf[i] = (n & 0x7F) | 0x80
+        n >>= 7
+        i += 1
+    buf[i] = n
+    return i + 1
+
+def get_varint(buf, i):
+    n = 0
+    shift = 0
+    while True:
+        b = buf[i]
+        i += 1
+        n |= (b & 0x7F) << shift
+        if b < 0x80: return n, i
+        shift += 7
+
+def encode_event(buf, i, delta, kind, value):
+    ''' Puts an event into buf at i, and returns where it ends.'''
+    i = put_varint(buf, i, (delta << 3) | kind)
+    if HAS_VALUE[kind]:
+        if value < 0: i = put_varint(buf, i, -2 * value - 1)    # Zigzag, for signed values
+        else: i = put_varint(buf, i, 2 * value)
+    return i
+
+def page_events(page, npower=0, ncheck=0):
+    ''' Decodes one page of the event log.  Yields (kind, t, value, count, end) for each
+    event, where count is the running total for power ups and time checks (else 0),
+    going on from npower and ncheck, and end is where the event ends in the page.'''
+    seq, t = struct.unpack_from(HIST_FORMAT, page, 0)
+    i = HIST_HEADER
+    while i < PAGE_SIZE and page[i] != 0:
+        n, i = get_varint(page, i)
+        kind = n & 7
+        t += n >> 3
+        value = 0
+        if HAS_VALUE[kind]:
+            z, i = get_varint(page, i)
+            if z & 1: value = -(z >> 1) - 1
+            else: value = z >> 1
+        count = 0
+        if kind == EV_POWER_UP:
+            npower += 1
+            count = npower
+        elif kind == EV_TIME_CHECK:
+            ncheck += 1
+            count = ncheck
+        yield kind, t, value, count, i
+
+def hist_reset():
+    ''' Forgets what is known about the event log, so it is scanned again.'''
+    global hist_page
+    hist_page = None
+    last_events.clear()
+
+def hist_load():
+    ''' Finds the newest page of the event log, the first time it is needed.  If the
+    settings store doesn't say the log has been set up, the pages still hold the old
+    catalogs, and they are moved into a new log.'''
+    global hist_page, hist_seq, hist_used, hist_last_t
+    if hist_page is not None: return
+    hist_page = -1
+    hist_seq = 0
+    hist_used = PAGE_SIZE
+    hist_last_t = 0
+    hist_totals[0] = hist_totals[1] = 0
+    last_events.clear()
+    if kv_get(KEY_HISTORY) != bytes((HIST_VERSION,)):
+        migrate_history()
+        return
+    last = kv_get(KEY_LAST_EVENTS)
+    if last is not None:
+        npower, tpower, ncheck, tcheck = struct.unpack(LAST_FORMAT, last)
+        hist_totals[0] = npower
+        hist_totals[1] = ncheck
+        if npower > 0: last_events[EV_POWER_UP] = (tpower, 0, npower)
+        if ncheck > 0: last_events[EV_TIME_CHECK] = (tcheck, 0, ncheck)
+    newest = -1
+    for i in range(HIST_PAGES):
+        page = hist_page_at(i)
+        if page is None: continue
+        if newest < 0 or (page[0] - hist_seq) % 255 < 128:
+            newest = i
+            hist_seq = page[0]
+    if newest < 0: return
+    hist_page = newest
+    hist_buf[:] = hist_page_at(newest)
+    hist_last_t = struct.unpack_from(HIST_FORMAT, hist_buf, 0)[1]
+    hist_used = HIST_HEADER
+    for kind, t, value, count, end in page_events(hist_buf):
+        hist_used = end
+        hist_last_t = t
+    # Go back through the pages from the head, taking the totals down to what they were
+    # before each page, and picking up the last event of the other kinds.
+    npower, ncheck = hist_totals
+    for pos in range(HIST_PAGES, 0, -1):
+        i = (hist_page + pos) % HIST_PAGES
+        page = hist_page_at(i)
+        if page is None: continue
+        found = {}
+        for kind, t, value, count, end in page_events(page):
+            if kind == EV_POWER_UP: npower -= 1
+            elif kind == EV_TIME_CHECK: ncheck -= 1
+            else: found[kind] = (t, value, 0)
+        page_totals[i] = (npower, ncheck)
+        for kind in found:
+            if kind not in last_events: last_events[kind] = found[kind]
+
+def write_head():
+    ''' Seals the head page with its crc, and writes it (into the eeprom cache).'''
+    struct.pack_into("<H", hist_buf, HIST_CRC, crc16(hist_buf[HIST_HEADER:], crc16(hist_buf[:HIST_CRC])))
+    rt.write_eeprom((HIST_PAGE0 + hist_page) * PAGE_SIZE, hist_buf)
+
+def write_last_events():
+    ''' Saves the power up and time check totals, and the times of the last ones.'''
+    tpower = last_events.get(EV_POWER_UP, (0,))[0]
+    tcheck = last_events.get(EV_TIME_CHECK, (0,))[0]
+    kv_put(KEY_LAST_EVENTS, struct.pack(LAST_FORMAT, hist_totals[0], tpower, hist_totals[1], tcheck))
+
+def add_event(kind, value, t):
+    ''' Adds an event to the log, without saving the totals.'''
+    global hist_page, hist_seq, hist_used, hist_last_t
+    end = PAGE_SIZE
+    if t >= hist_last_t: end = encode_event(event_buf, 0, t - hist_last_t, kind, value)
+    if hist_used + end > PAGE_SIZE:
+        # Start a new page, based at this event's time.
+        hist_page = (hist_page + 1) % HIST_PAGES
+        hist_seq = hist_seq % 255 + 1
+        for i in range(PAGE_SIZE): hist_buf[i] = 0
+        struct.pack_into(HIST_FORMAT, hist_buf, 0, hist_seq, t)
+        page_totals[hist_page] = (hist_totals[0], hist_totals[1])
+        hist_used = HIST_HEADER
+        end = encode_event(event_buf, 0, 0, kind, value)
+    hist_buf[hist_used:hist_used + end] = event_buf[:end]
+    hist_used += end
+    hist_last_t = t
+    write_head()
+    count = 0
+    if kind == EV_POWER_UP:
+        hist_totals[0] += 1
+        count = hist_totals[0]
+    elif kind == EV_TIME_CHECK:
+        hist_totals[1] += 1
+        count = hist_totals[1]
+    last_events[kind] = (t, value, count)
+
+def log_event(kind, value=0, t=None):
+    ''' Adds an event to the log.  t is in UTC seconds, and defaults to now.'''
+    hist_load()
+    if t is None: t = rt.utc_now()
+    add_event(kind, value, t)
+    if kind == EV_POWER_UP or kind == EV_TIME_CHECK: write_last_events()
+
+def page_base(pos):
+    ''' Returns the base time of the page at a ring position, from 1 for the oldest page to
+    HIST_PAGES for the head, or None if the page isn't in use.'''
+    page = hist_page_at((hist_page + pos) % HIST_PAGES)
+    if page is None: return None
+    return struct.unpack_from(HIST_FORMAT, page, 0)[1]
+
+def find_page(t):
+    ''' Binary searches the ring for the last page that starts before t, and returns its
+    position (1 if there is none).  Pages not in use are at the old end of the ring, so
+    they count as before everything.'''
+    lo = 1
+    hi = HIST_PAGES
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        base = page_base(mid)
+        if base is None or base < t: lo = mid
+        else: hi = mid - 1
+    return lo
+
+def events(since=None, until=None, kinds=None, limit=None, newest_first=False):
+    ''' Yields an Event (kind, unix-time, value, count) for each event in the log with
+    since <= time < until, of the given kinds, if those are set, and up to limit of
+    them.  They come oldest first, or newest first if asked.  The pages to read are
+    found by a binary search on their base times, so a small range reads only a page
+    or two.  That takes the times to go forward: an event logged after the clock was
+    set back can be left out of a range it falls in.'''
+    hist_load()
+    if hist_page < 0: return
+    n = 0
+    if newest_first:
+        pos = HIST_PAGES
+        if until is not None: pos = find_page(until)
+        step = -1
+    else:
+        pos = 1
+        if since is not None: pos = find_page(since)
+        step = 1
+    while 1 <= pos <= HIST_PAGES:
+        i = (hist_page + pos) % HIST_PAGES
+        page = hist_page_at(i)
+        pos += step
+        if page is None: continue
+        base = struct.unpack_from(HIST_FORMAT, page, 0)[1]
+        if not newest_first and until is not None and base >= until: return
+        npower, ncheck = page_totals[i]
+        found = []
+        for kind, t, value, count, end in page_events(page, npower, ncheck):
+            if kinds is not None and kind not in kinds: continue
+            if since is not None and t < since: continue
+            if until is not None and t >= until: continue
+            if newest_first: found.append(Event(kind, t, value, count))
+            else:
+                yield Event(kind, t, value, count)
+                n += 1
+                if limit is not None and n >= limit: return
+        for i in range(len(found) - 1, -1, -1):
+            yield found[i]
+            n += 1
+            if limit is not None and n >= limit: return
+        if newest_first and since is not None and base < since: return
+
+def migrate_history():
+    ''' Sets up the event log, moving the records of the old power up and time check
+    catalogs into it.  Their counts carry on from where they were, and the totals are
+    saved once at the end.  A catalog is only
+    moved if it looks like one: its counts must be a run with no gaps or repeats, as
+    the ring of the last 64 counts always is.  Then the pages are cleared and the log
+    is marked as set up, so this is only done once.'''
+    old = []
+    for kind, page0 in ((EV_POWER_UP, PAGE_PWR_CYC), (EV_TIME_CHECK, PAGE_TIME_CHK)):
+        recs = []
+        for i in range(NPAGES):
+            buf = rt.peek_eeprom((page0 + i) * PAGE_SIZE, PAGE_SIZE)
+            for j in range(RECS_PER_PAGE):
+                c, t = struct.unpack_from("<LL", buf, j * REC_SIZE)
+                if c > 0: recs.append((t, c, kind))
+        if not recs: continue
+        counts = sorted([c for t, c, k in recs])
+        if counts[-1] - counts[0] + 1 != len(counts) or len(set(counts)) != len(counts):
+            print("Old history catalog at page %d doesn't look right, not moved." % page0)
+            continue
+        old += recs
+        hist_totals[kind - 1] = counts[0] - 1
+    old.sort()
+    buf = bytearray(PAGE_SIZE)
+    for i in range(HIST_PAGES): rt.write_eeprom((HIST_PAGE0 + i) * PAGE_SIZE, buf)
+    kv_put(KEY_HISTORY, bytes((HIST_VERSION,)))
+    for t, c, kind in old: add_event(kind, 0, t)
+    write_last_events()
 
 def power_cycle_increment(t):
     ''' Increment the power cycle count and store the time in the history.'''
-    ipage, indx, count, tt = get_last(PAGE_PWR_CYC)
-    count += 1
-    indx += 1
-    if indx >= RECS_PER_PAGE:
-        indx = 0
-        ipage += 1
-        if ipage >= NPAGES: ipage = 0
-    buf = struct.pack("LL", count, t)
-    write_record(ipage + PAGE_PWR_CYC, indx, buf)
+    log_event(EV_POWER_UP, 0, t)
     
-def time_check(t):
-    ''' Store the time that the time was checked with ntp, or manually.'''
-    ipage, indx, count, tt = get_last(PAGE_TIME_CHK)
-    count += 1
-    indx += 1
-    if indx >= RECS_PER_PAGE:
-        indx = 0
-        ipage += 1
-        if ipage >= NPAGES: ipage = 0
-    buf = struct.pack("LL", count, t)
-    write_record(ipage + PAGE_TIME_CHK, indx, buf)
+def time_check(t, offset=None, latency_ms=None):
+    ''' Store the time that the time was checked with ntp, or manually.  For ntp, also
+    store how far off the clock was (in seconds) and how long the request took.'''
+    log_event(EV_TIME_CHECK, 0, t)
+    if offset is not None: log_event(EV_NTP_OFFSET, offset, t)
+    if latency_ms is not None: log_event(EV_SYNC_LATENCY, latency_ms, t)
+
+def get_records(kind, since=None, until=None, limit=None, newest_first=False):
+    ''' Yields the (count, unix-time) records of power ups or time checks, oldest first.
+    Only records with since <= time < until are given, if those are set.'''
+    for e in events(since, until, (kind,), limit, newest_first): yield e.count, e.t
+
+def get_last_event(kind):
+    ''' Returns (unix-time, value, count) of the last event of a kind, or None.'''
+    hist_load()
+    return last_events.get(kind)
     
 def get_last_time_check():
     ''' Returns the UTC time of the last time sync from eeprom. Or None
     if nothing found.'''
-    ipage, indx, count, tt = get_last(PAGE_TIME_CHK)
-    if count <= 0: return None
-    return tt
+    e = get_last_event(EV_TIME_CHECK)
+    if e is None: return None
+    return e[0]
 
 def get_last_power_cycle():
     ''' Returns the UTC time of the last time the clock was powered up, or
     None if nothing found.'''
-    ipage, indx, count, tt = get_last(PAGE_PWR_CYC)
-    if count <= 0: return None
-    return tt
-
-def list_recs(page0):
-    ''' List records found in history, given the starting page number.'''
-    result_string = ""
-    for i in range(NPAGES):
-        buf = rt.read_eeprom((page0 + i)*PAGE_SIZE, PAGE_SIZE)
-        for j in range(RECS_PER_PAGE):
-            c, t = struct.unpack_from("LL", buf, j*8)
-            #print(f"c={c} t={t}")
-            tme = time.localtime(t)
-            s = "%2d-%2d: %6d  %s\n" % (i, j, c, str(tme))
-            #print(s)
-            if c > 0: result_string += s
-    
-    print(f"list_recs {page0}: \n {result_string}")
+    e = get_last_event(EV_POWER_UP)
+    if e is None: return None
+    return e[0]
+
+def rec_lines(kind=None, since=None, until=None, limit=None, newest_first=False):
+    ''' Yields a line for each event in history, of one kind or all of them.  The rest
+    of the arguments are as for events().'''
+    kinds = None
+    if kind is not None: kinds = (kind,)
+    for e in events(since, until, kinds, limit, newest_first):
+        if e.kind == EV_POWER_UP or e.kind == EV_TIME_CHECK: v = e.count
+        else: v = e.value
+        yield "%-12s %6d  %s\n" % (EVENT_NAMES[e.kind], v, str(time.localtime(e.t)))
+
+def list_recs(kind=None, since=None, until=None, limit=None, newest_first=False):
+    ''' List events found in history, of one kind or all of them.'''
+    result_string = "".join(rec_lines(kind, since, until, limit, newest_first))
+    print(f"list_recs {kind}: \n {result_string}")
     return result_string
             
-def list_power():
-    return list_recs(PAGE_PWR_CYC)
+def list_power(since=None, until=None, limit=None):
+    return list_recs(EV_POWER_UP, since, until, limit)
     
-def list_time_checks():
-    return list_recs(PAGE_TIME_CHK)
-
+def list_time_checks(since=None, until=None, limit=None):
+    return list_recs(EV_TIME_CHECK, since, until, limit)
@@ -0,0 +1,413 @@
+# i2csim.py -- Simulated I2C bus with the clock module's AT24C32 and DS3231
+
+# rtcmod uses this in place of the machine module when there is none, so rtcmod, history
+# and settings can be run, fuzzed and timed on a PC.  It gives the parts of machine that
+# rtcmod uses (I2C, SoftI2C, Pin and Timer), and on a PC it also adds ticks_ms(),
+# ticks_us(), ticks_diff() and ticks_add() to the time module, wrapping like micropython's.
+#
+# Time here is simulated: it is the real time since start up (or none at all, if
+# real_time is False) plus the time spent on the bus.  Each transaction costs the bits it
+# takes at the bus frequency, plus BUS_OVERHEAD_US, so the bus counters in rtcmod come
+# out close to what the clock sees.  advance(ms) moves time on, running the timers and the
+# square wave edges that come due on the way.  With real time, call poll() now and then to
+# run them.
+#
+# The AT24C32 keeps its 4K in RAM, or in a file (see eeprom_file()).  Writes wrap around
+# inside their 32 byte page, reads roll over from the end of the chip to the start, and
+# after a write the chip doesn't answer (NACKs) until its write cycle is done.
+#
+# The DS3231 counts seconds from the time it was set, at its drift rate plus the aging
+# offset (0.1 ppm per step, positive is slower).  Its time registers are BCD, with the 12
+# or 24 hour mode of the hours register and the century bit, and the day of the week goes
+# on from what was written.  With INTCN clear and RS at 1 Hz, it puts out a falling edge on
+# its SQW pin at the start of each second.  Alarms are kept, but never go off.
+
+import time
+import civil
+from errno import EIO
+
+BUS_OVERHEAD_US = 10        # Software time per transaction, on top of the bits.
+real_time = True            # False stops the clock, except for the bus and advance().
+
+if hasattr(time, "monotonic_ns"): real_ns = time.monotonic_ns
+else: real_ns = time.time_ns
+start_ns = real_ns()
+skew_us = 0                 # Time added by the bus and advance().
+
+def clock_us():
+    ''' Returns the simulated time, in microseconds from start up.'''
+    if real_time: return (real_ns() - start_ns) // 1000 + skew_us
+    return skew_us
+
+# Ticks
+# The same as micropython's: they wrap at 2**30, so code that does its own math on ticks
+# breaks here too.
+
+TICKS_PERIOD = 1 << 30
+TICKS_HALF = TICKS_PERIOD // 2
+
+def ticks_us():
+    return clock_us() & (TICKS_PERIOD - 1)
+
+def ticks_ms():
+    return (clock_us() // 1000) & (TICKS_PERIOD - 1)
+
+def ticks_diff(a, b):
+    return ((a - b + TICKS_HALF) & (TICKS_PERIOD - 1)) - TICKS_HALF
+
+def ticks_add(a, delta):
+    return (a + delta) & (TICKS_PERIOD - 1)
+
+if not hasattr(time, "ticks_ms"):
+    time.ticks_ms = ticks_ms
+    time.ticks_us = ticks_us
+    time.ticks_diff = ticks_diff
+    time.ticks_add = ticks_add
+
+# Pins and Timers
+
+pins = {}                   # Pin number -> the Pin last made for it
+timers = []                 # Running timers
+
+class Pin:
+    IN = 0
+    OUT = 1
+    OPEN_DRAIN = 2
+    PULL_UP = 1
+    PULL_DOWN = 2
+    IRQ_FALLING = 4
+    IRQ_RISING = 8
+
+    def __init__(self, id, mode=-1, pull=-1, value=1):
+        self.id = id
+        self.level = value
+        self.handler = None
+        self.trigger = 0
+        pins[id] = self
+
+    def irq(self, handler=None, trigger=IRQ_FALLING | IRQ_RISING):
+        self.handler = handler
+        self.trigger = trigger
+
+    def value(self, v=None):
+        if v is None: return self.level
+        self.level = v
+
+    def __call__(self, v=None):
+        return self.value(v)
+
+class Timer:
+    ONE_SHOT = 0
+    PERIODIC = 1
+
+    def __init__(self, id=-1, mode=PERIODIC, period=-1, callback=None):
+        self.due = None
+        if callback is not None: self.init(mode=mode, period=period, callback=callback)
+
+    def init(self, mode=PERIODIC, period=-1, callback=None, freq=-1):
+        if freq > 0: period = 1000 // freq
+        self.mode = mode
+        self.period = period
+        self.callback = callback
+        self.due = clock_us() + period * 1000
+        if self not in timers: timers.append(self)
+
+    def deinit(self):
+        self.due = None
+        if self in timers: timers.remove(self)
+
+def next_event():
+    ''' Returns (due, timer) for the next timer or square wave edge, or (None, None).'''
+    due = rtc.next_edge_us()
+    first = None
+    for t in timers:
+        if due is None or t.due < due:
+            due = t.due
+            first = t
+    return due, first
+
+def run_until(t_us):
+    ''' Runs everything that comes due up to t_us, with the clock moved on to each.'''
+    global skew_us
+    while True:
+        due, timer = next_event()
+        if due is None or due > t_us: return
+        now = clock_us()
+        if due > now: skew_us += due - now
+        if timer is None: rtc.edge()
+        else:
+            if timer.mode == Timer.PERIODIC: timer.due += timer.period * 1000
+            else: timer.deinit()
+            timer.callback(timer)
+
+def poll():
+    ''' Runs the timers and square wave edges that are due by now.'''
+    run_until(clock_us())
+
+def advance(ms):
+    ''' Moves the simulated time on by ms, running whatever comes due on the way.'''
+    global skew_us
+    target = clock_us() + int(ms * 1000)
+    run_until(target)
+    now = clock_us()
+    if target > now: skew_us += target - now
+
+# Devices
+# A device takes the bytes of a write after its address with write(), and fills a buffer
+# from where it is pointing with read().  ack() is False while it isn't answering.
+
+def to_bcd(x):
+    return ((x // 10) << 4) | (x % 10)
+
+def from_bcd(b):
+    return (b >> 4) * 10 + (b & 0x0F)
+
+class AT24C32:
+    SIZE = 4096
+    PAGE = 32
+    WRITE_CYCLE_US = 5000   # Typical.  The data sheet allows up to 10 ms.
+
+    def __init__(self, path=None):
+        self.file = None
+        if path is None: self.mem = bytearray(b'\xff' * self.SIZE)
+        else:
+            import mmap
+            try: self.file = open(path, "r+b")
+            except OSError:
+                self.file = open(path, "w+b")
+                self.file.write(b'\xff' * self.SIZE)
+                self.file.flush()
+            self.mem = mmap.mmap(self.file.fileno(), self.SIZE)
+        self.ptr = 0
+        self.busy_until = 0
+        self.page_writes = 0
+
+    def close(self):
+        if self.file is not None:
+            self.mem.close()
+            self.file.close()
+            self.file = None
+
+    def ack(self):
+        return clock_us() >= self.busy_until
+
+    def write(self, data):
+        if len(data) < 2: return
+        self.ptr = ((data[0] << 8) | data[1]) & (self.SIZE - 1)
+        if len(data) == 2: return      # Just setting the address, for a read.
+        page = self.ptr & ~(self.PAGE - 1)
+        off = self.ptr & (self.PAGE - 1)
+        for i in range(2, len(data)):
+            self.mem[page + off] = data[i]
+            off = (off + 1) & (self.PAGE - 1)
+        self.ptr = page + off
+        self.page_writes += 1
+        self.busy_until = clock_us() + self.WRITE_CYCLE_US
+
+    def read(self, buf):
+        n = len(buf)
+        i = 0
+        while i < n:
+            k = min(n - i, self.SIZE - self.ptr)
+            buf[i:i + k] = self.mem[self.ptr:self.ptr + k]
+            i += k
+            self.ptr = (self.ptr + k) & (self.SIZE - 1)
+
+class DS3231:
+    NREGS = 0x13
+    REG_HOURS = 0x02
+    REG_CONTROL = 0x0E
+    REG_STATUS = 0x0F
+    REG_AGING = 0x10
+
+    def __init__(self, t=None, drift_ppm=0.0, sqw_pin=6):
+        ''' Starts the clock at t, a UTC (year, month, date, hours, minutes, seconds)
+        tuple, or at the time of the PC.'''
+        self.regs = bytearray(self.NREGS)
+        self.regs[self.REG_CONTROL] = 0x1C     # INTCN set, RS at 8 kHz
+        self.regs[self.REG_STATUS] = 0x88      # Oscillator stopped flag, 32 kHz on
+        self.regs[0x11] = 25                   # 25.00 C
+        self.drift_ppm = drift_ppm
+        self.sqw_pin = sqw_pin
+        self.ptr = 0
+        self.mode12 = False
+        if t is None: t = time.gmtime()
+        self.set_count(civil.days_from_civil(t[0], t[1], t[2]) * 86400 + t[3] * 3600 + t[4] * 60 + t[5])
+        self.dow_base = civil.weekday_of(t[0], t[1], t[2]) + 1
+        self.dow_days = self.base_secs // 86400
+
+    def rate(self):
+        aging = self.regs[self.REG_AGING]
+        if aging > 127: aging -= 256
+        return 1 + (self.drift_ppm - 0.1 * aging) * 1e-6
+
+    def set_count(self, secs):
+        ''' Starts second secs (from 1/1/1970) now, as writing the seconds register does.'''
+        self.base_secs = secs
+        self.base_us = clock_us()
+        self.fired = secs
+
+    def count(self):
+        ''' Returns the seconds counted, from 1/1/1970.'''
+        return self.base_secs + int((clock_us() - self.base_us) * self.rate() // 1000000)
+
+    def rebase(self):
+        ''' Moves the base up to the start of the current second, before the rate changes.'''
+        n = self.count()
+        self.base_us += int((n - self.base_secs) * 1000000 / self.rate())
+        self.base_secs = n
+
+    def latch(self):
+        ''' Puts the current time into the time registers.'''
+        n = self.count()
+        z = n // 86400
+        s = n - z * 86400
+        y, m, d = civil.civil_from_days(z)
+        h = s // 3600
+        r = self.regs
+        r[0] = to_bcd(s % 60)
+        r[1] = to_bcd(s // 60 % 60)
+        if self.mode12:
+            r[2] = 0x40 | to_bcd(h % 12 or 12)
+            if h >= 12: r[2] |= 0x20
+        else: r[2] = to_bcd(h)
+        r[3] = (self.dow_base - 1 + z - self.dow_days) % 7 + 1
+        r[4] = to_bcd(d)
+        r[5] = to_bcd(m)
+        if y >= 2100: r[5] |= 0x80
+        r[6] = to_bcd(y % 100)
+
+    def set_from_regs(self):
+        r = self.regs
+        if r[2] & 0x40:
+            self.mode12 = True
+            h = from_bcd(r[2] & 0x1F) % 12
+            if r[2] & 0x20: h += 12
+        else:
+            self.mode12 = False
+            h = from_bcd(r[2] & 0x3F)
+        y = 2000 + from_bcd(r[6])
+        if r[5] & 0x80: y += 100
+        z = civil.days_from_civil(y, from_bcd(r[5] & 0x1F), from_bcd(r[4] & 0x3F))
+        self.set_count(z * 86400 + h * 3600 + from_bcd(r[1] & 0x7F) * 60 + from_bcd(r[0] & 0x7F))
+        self.dow_base = r[3] & 0x07 or 1
+        self.dow_days = z
+
+    def ack(self):
+        return True
+
+    def write(self, data):
+        if len(data) < 1: return
+        self.ptr = data[0] % self.NREGS
+        if len(data) == 1: return
+        self.rebase()
+        self.latch()
+        set_time = False
+        for i in range(1, len(data)):
+            b = data[i]
+            if self.ptr <= 6: set_time = True
+            if self.ptr == self.REG_STATUS:
+                # OSF and the alarm flags can only be cleared, BSY is read only.
+                old = self.regs[self.ptr]
+                b = (old & b & 0x83) | (b & 0x08) | (old & 0x04)
+            if self.ptr < 0x11: self.regs[self.ptr] = b    # Temperature is read only.
+            self.ptr = (self.ptr + 1) % self.NREGS
+        if set_time: self.set_from_regs()
+        elif self.sqw_on(): self.fired = max(self.fired, self.count())
+
+    def read(self, buf):
+        self.latch()
+        for i in range(len(buf)):
+            buf[i] = self.regs[self.ptr]
+            self.ptr = (self.ptr + 1) % self.NREGS
+
+    def sqw_on(self):
+        return self.regs[self.REG_CONTROL] & 0x1C == 0
+
+    def next_edge_us(self):
+        ''' Returns when the next falling edge of the square wave is, or None.'''
+        pin = pins.get(self.sqw_pin)
+        if not self.sqw_on() or pin is None or pin.handler is None or not pin.trigger & Pin.IRQ_FALLING: return None
+        n = self.count()
+        if self.fired < n - 1: self.fired = n - 1      # Edges missed while not polled are lost.
+        return self.base_us + int((self.fired + 1 - self.base_secs) * 1000000 / self.rate()) + 1
+
+    def edge(self):
+        self.fired += 1
+        pin = pins[self.sqw_pin]
+        pin.handler(pin)
+
+eeprom = AT24C32()
+rtc = DS3231()
+devices = {0x57: eeprom, 0x68: rtc}
+
+def eeprom_file(path):
+    ''' Puts the eeprom in a file, made blank if it isn't there.  Call before rtcmod first
+    reads the eeprom, or call rtcmod.load_eeprom() after.'''
+    global eeprom
+    eeprom.close()
+    eeprom = AT24C32(path)
+    devices[0x57] = eeprom
+
+# Bus
+
+class I2C:
+    def __init__(self, id=0, scl=None, sda=None, freq=400_000):
+        self.freq = freq
+
+    def start(self, addr, bits):
+        ''' Charges the time for a transaction of so many bits, and returns the device
+        if it answers its address.'''
+        global skew_us
+        skew_us += bits * 1000000 // self.freq + BUS_OVERHEAD_US
+        dev = devices.get(addr)
+        if dev is None or not dev.ack():
+            raise OSError(EIO)
+        return dev
+
+    def mem_addr(self, mem, addrsize):
+        return bytes((mem >> 8, mem & 0xFF)) if addrsize == 16 else bytes((mem & 0xFF,))
+
+    def readfrom_mem_into(self, addr, mem, buf, addrsize=8):
+        dev = self.start(addr, 30 + 9 * (addrsize // 8 + len(buf)))
+        dev.write(self.mem_addr(mem, addrsize))
+        dev.read(buf)
+
+    def readfrom_mem(self, addr, mem, n, addrsize=8):
+        buf = bytearray(n)
+        self.readfrom_mem_into(addr, mem, buf, addrsize)
+        return bytes(buf)
+
+    def writeto_mem(self, addr, mem, buf, addrsize=8):
+        dev = self.start(addr, 20 + 9 * (addrsize // 8 + len(buf)))
+        dev.write(self.mem_addr(mem, addrsize) + bytes(buf))
+
+    def readfrom_into(self, addr, buf):
+        self.start(addr, 20 + 9 * len(buf)).read(buf)
+
+    def writeto(self, addr, buf):
+        self.start(addr, 20 + 9 * len(buf)).write(bytes(buf))
+        return len(buf)
+
+    def scan(self):
+        return [addr for addr in sorted(devices) if devices[addr].ack()]
+
+class SoftI2C(I2C):
+    def __init__(self, scl=None, sda=None, freq=100_000):
+        self.freq = freq
+
+def bench(n=200):
+    ''' Logs n history events and saves them, on the simulated bus, and prints what it
+    cost.'''
+    import rtcmod as rt
+    import history as hist
+    hist.init_eeprom()
+    rt.wait_idle()
+    rt.reset_bus_stats()
+    t0 = clock_us()
+    t = rt.utc_now()
+    for i in range(n): hist.log_event(hist.EV_BRIGHTNESS, i, t + i)
+    rt.wait_idle()
+    print("%d events in %.1f ms of bus time (simulated %.1f ms)" % (n, sum(rt.bus_us) / 1000, (clock_us() - t0) / 1000))
+    print(rt.get_bus_stats())
+    print(rt.get_eeprom_stats())
@@ -71,6 +71,7 @@ import neo
 import ntptime as ntp
 import rtcmod as rtc
 import timehelp as th
+import civil
 import time
 import next_color
 import encoder
@@ -79,6 +80,7 @@ import access_point
 import log
 import gc
 import render_styles as RenderStyles
+import settings
 
 Version = "V0.9, 12/10/23"
 ClockId = "dev_unit"
@@ -120,29 +122,53 @@ is_blink = False
 crash_counter = 0
 last_crash = 0
 
+# Display Scheduler
+# update_display() runs off a one shot timer that re-arms itself, so the refresh rate can
+# follow what is on the display.  The face only changes once a second, so the display
+# sleeps until the next second starts.  There is no faster frame rate for animations:
+# they run from on_loop() in the main loop, paced by the delay each frame asks for, and
+# the ticks leave the display alone while one plays.  The time comes from rtcmod's
+# anchored time, which also says exactly where each second starts, so a tick never waits
+# on the I2C bus.  rtcmod.sync() keeps the anchor
+# in line with the rtc from on_loop().
+# During a critical time the digits blink on the half second, which adds one more tick.
+# When the rtc's square wave is wired up, its edge starts each second's tick instead, and
+# the timer only wakes EDGE_SLACK_MS later in case an edge goes missing.
+# How late each tick and each animation frame ran and how long it took are logged in neo,
+# see neo.get_frame_stats().
+
+BLINK_MS = 500         # Where in the second the digits switch to the blink color.
+EDGE_SLACK_MS = 20     # How long to wait past the expected second for the square wave.
+
+display_running = False
+tick_due = 0           # ticks_ms() at which the next tick should run.
+second_start = 0       # ticks_ms() at which the current second started.
+display_time = None    # Local time at second_start.
+is_critical = False
+
 def update_display(timer):
-    global blink_even, blink_counter, digit_color, brightness, is_blink, crash_counter, last_crash
-    
+    global digit_color, brightness, is_blink, crash_counter, last_crash, is_critical
+    now = time.ticks_ms()
+    t0 = time.ticks_us()
+    late = time.ticks_diff(now, tick_due)
     try:
-        gc.collect()
-        tlocal = find_time()
-
-        digit_color_override, digit_blink_color = critical_time_check(tlocal)
-        if is_blink: digit_color_override = digit_blink_color
-        
-        #todo fix colon color override for stale time
-        #colon_color_override = update_colon_color(tlocal, hist.get_last_time_check())
-        colon_color_override = colon_color
-        
-        #print(f"timer fired. Digit color: {digit_color}")
-
-        neo.solid(neo.c_black)
-        neo.render_time(h12, m, s, is_am, digit_color_override, colon_color_override, seconds_color, am_color, brightness, render_style)
-        draw_menu_light()
-        neo.show()
-        is_blink = not is_blink
-        last_s = s
-        gc.collect()
+        if display_time is None or time.ticks_diff(now, second_start) >= 1000:
+            sample_time(now)
+
+        # An animation owns the display while it runs.
+        if not neo.is_animating():
+            gc.collect()
+            digit_color_override, digit_blink_color = critical_time_check(display_time)
+            is_critical = digit_blink_color != digit_color_override
+            is_blink = time.ticks_diff(now, second_start) >= BLINK_MS
+            if is_blink: digit_color_override = digit_blink_color
+            
+            #todo fix colon color override for stale time
+            #colon_color_override = update_colon_color(tlocal, hist.get_last_time_check())
+            colon_color_override = colon_color
+            
+            #print(f"timer fired. Digit color: {digit_color}")
+            draw_clock(digit_color_override, colon_color_override)
         #if is_blink: raise Exception("Test exception in display timer!") #used to test the crash logging
     except Exception as e:
         crash_counter += 1
@@ -150,50 +176,76 @@ def update_display(timer):
         if current_time - last_crash <= 10:  # If crashes occur within 10 seconds
             if crash_counter >= 10:
                 log.log_exception(e, fatal=True)
+                hist.log_event(hist.EV_CRASH, 1)
                 stop_timer() #let it just stop working to prevent spamming the log forever
             else:
                 log.log_exception(e, fatal=False) #less than ten crashes in 10 seconds so logging as non fatal and the dipslay timer will call again
         else:
             crash_counter = 1  # Reset counter if more than 10 seconds have passed since last crash
         last_crash = current_time
+    neo.record_frame(late, time.ticks_diff(time.ticks_us(), t0))
+    if display_running: schedule_display(next_display_delay(time.ticks_ms()))
+
+def sample_time(now):
+    ''' Gets the time and notes when the current second started.'''
+    global display_time, second_start
+    display_time = find_time()
+    if s < 0:
+        # No valid time, so nothing to line up with.  Just tick once a second.
+        second_start = now
+    else: second_start = rtc.second_start(now)
+
+def next_display_delay(now):
+    ''' Returns how long the display can sleep before its next tick.'''
+    into = time.ticks_diff(now, second_start)
+    if is_critical and into < BLINK_MS: return BLINK_MS - into
+    if rtc.sqw_running(now): return 1000 - into + EDGE_SLACK_MS
+    return 1000 - into
+
+def second_edge(now):
+    ''' Called by rtcmod on each edge of the rtc's square wave, as a new second starts.'''
+    global display_time
+    if display_running and not neo.is_animating():
+        display_time = None     # Take the new second on the next tick.
+        schedule_display(1)
+
+def schedule_display(delay_ms):
+    global tick_due
+    if delay_ms < 1: delay_ms = 1
+    tick_due = time.ticks_add(time.ticks_ms(), delay_ms)
+    display_timer.init(period=delay_ms, mode=Timer.ONE_SHOT, callback=update_display)
     
-dst_lockout = False
 last_dst = True
 def find_time():
-    global h12, m, s, is_am, dst_lockout, last_dst
-    t = rtc.get_time()
-    tutc = time.mktime(t)
-    years = t[0]
+    ''' Gets the time from the rtc's anchor and sets h12, m, s and is_am.  Returns local
+    time in seconds.'''
+    global h12, m, s, is_am, last_dst
+    tutc = rtc.utc_now()
 
-    if not is_valid_time(years):
+    if not is_valid_time(tutc):
         h12 = -1
         m = -1
         s = -1
         is_am = True
         return tutc
     
-    if last_dst: tlocal = th.apply_offset(t, th.pdt_offset)
-    else:        tlocal = th.apply_offset(t, th.pst_offset)
-    if not dst_lockout:
-        new_dst = th.daylight_savings_check(tlocal)
-        if new_dst != last_dst:
-            if new_dst: print("Daylight Savings is changing to ON.")
-            else:       print("Daylight Savings is changing to OFF.")
-            last_dst = new_dst
-            if last_dst: tlocal = th.apply_offset(t, th.pdt_offset)
-            else:        tlocal = th.apply_offset(t, th.pst_offset)
-            dst_lockout = True
-    else:
-        h = tlocal[3]
-        if h > 8: dst_lockout = False
-
-    h, m, s = tlocal[3], tlocal[4], tlocal[5]
+    offset = th.utc_offset(tutc)
+    new_dst = offset != th.zone.std_offset
+    if new_dst != last_dst:
+        if new_dst: print("Daylight Savings is changing to ON.")
+        else:       print("Daylight Savings is changing to OFF.")
+        last_dst = new_dst
+    tlocal = tutc + offset
+
+    h, m, s = tlocal // 3600 % 24, tlocal // 60 % 60, tlocal % 60
     is_am = h < 12
     h12 = th.h24_to_h12(h)
     return tlocal
 
-def is_valid_time(years):
-    return years >= 2010
+valid_from = civil.seconds((2010, 1, 1, 0, 0, 0))
+
+def is_valid_time(tutc):
+    return tutc >= valid_from
 
 def update_colon_color(tutc, tlast_update):
     
@@ -209,9 +261,9 @@ def update_colon_color(tutc, tlast_update):
     return colon_color
         
 def critical_time_check(t):
-    " Returns params for critical times, if active."
-    wd = th.day_of_week(t)
-    tchk = t[3] + (t[4] / 60.0)
+    " Returns params for critical times, if active.  t is local time in seconds."
+    wd = th.weekday(t)
+    tchk = t // 3600 % 24 + (t // 60 % 60) / 60.0
     for ct in critical_times:
         t1, t2, wds, c1, c2 = ct
         tc1 = t1[0] + t1[1] / 60.0
@@ -276,6 +328,7 @@ def wait_for_network_time(must_connect = False):
         tstart = time.time()
         t = None
         while True:
+            t0 = time.ticks_ms()
             t = ntp.ntp()
             if t is not None: break
             icount += 1
@@ -289,8 +342,10 @@ def wait_for_network_time(must_connect = False):
             time.sleep(6.0)
             if not must_connect: return ssid, pw
             continue
+        latency = time.ticks_diff(time.ticks_ms(), t0)
+        offset = rtc.utc_now() - t
         rtc.set_time(time.localtime(t))
-        hist.time_check(t)
+        hist.time_check(t, offset, latency)
         str_tme = str(time.localtime(t))
         print("NTP Time Recevied.")
         print("Setting RTC Module to UTC Time: %s" % str_tme)
@@ -303,12 +358,9 @@ def wait_for_network_time(must_connect = False):
 def startup():
     global time_valid
     print("Clock Startup. Id=%s   Version=%s" % (ClockId, Version))
-    read_history()
-    neo.set_global_brightness(brightness)
-    
     print("Running rainbow_animation anaimation...")
-    #def rainbow_animation(loops=50, dim_amount = .93, initial_brightness=0.1, speed=56):
-    neo.rainbow_animation(15, .8, brightness)
+    #def rainbow_animation(loops=50, dim_amount = .93, initial_brightness=1.0, speed=56):
+    neo.rainbow_animation(15, .8)
     print("Initializing eeprom...")
     hist.init_eeprom()
     tuse = rtc.get_time()
@@ -325,14 +377,19 @@ def startup():
     ssid, pw = wait_for_network_time(must_connect = not time_valid)
 
 def start_timer():
-    display_timer.init(period=500, mode=Timer.PERIODIC, callback=update_display)
+    ''' Starts the display ticking, or hurries up the next tick if it already is.'''
+    global display_running
+    display_running = True
+    schedule_display(1)
     
 def stop_timer():
+    global display_running
+    display_running = False
     display_timer.deinit()
     
 def read_history():
     '''reads the history from eeprom and saves it to our global variables'''
-    global brightness, digit_color, digit_color_state, colon_color, colon_color_state, seconds_color, seconds_state, am_color, am_color_state, render_style
+    global brightness, digit_color, digit_color_state, colon_color, colon_color_state, seconds_color, seconds_color_state, am_color, am_color_state, render_style
 
     try:
         brightness = hist.read_brightness()
@@ -345,9 +402,19 @@ def read_history():
         digit_color, digit_color_state, colon_color, colon_color_state, seconds_color, seconds_color_state, am_color, am_color_state = hist.read_colors()
         
         render_style = hist.read_render_style()
+
+        tz = hist.read_timezone()
+        if tz != "": th.set_timezone(tz)
+        settings.load("digit_color", (digit_color, digit_color_state))
+        settings.load("colon_color", (colon_color, colon_color_state))
+        settings.load("seconds_color", (seconds_color, seconds_color_state))
+        settings.load("am_color", (am_color, am_color_state))
+        settings.load("brightness", brightness)
+        settings.load("render_style", render_style)
+        settings.load("timezone", tz)
     except Exception as e:
         print("could not read history! Excepion is: ",e)
-    print(f"Saved color is: {digit_color}, saved state is: {digit_color_state}, saved colon color is: {colon_color}, saved colon state is: {colon_color_state}, saved brightness is: {brightness}, render style: {render_style}")
+    print(f"Saved color is: {digit_color}, saved state is: {digit_color_state}, saved colon color is: {colon_color}, saved colon state is: {colon_color_state}, saved brightness is: {brightness}, render style: {render_style}, time zone: {th.get_timezone()}")
 
 def has_been_setup():
     global ssid, pw
@@ -358,6 +425,8 @@ def has_been_setup():
 
 def run():
     global time_valid, brightness, clock_state, digit_color, colon_color, seconds_color, am_color, display_timer, is_connected
+    read_history()
+    neo.set_global_brightness(brightness)
     if not has_been_setup():
         access_point.run(access_point.scroll_text)
         machine.soft_reset() #should never get here. access_point should loop forever
@@ -365,7 +434,11 @@ def run():
     startup()
     clock_state = ClockStates.BRIGHTNESS
     state_loops = 0
-    display_timer = Timer(period=500, mode=Timer.PERIODIC, callback=update_display)
+    display_timer = Timer()
+    rtc.sync()      # Anchors the time before the display needs it.
+    rtc.on_second = second_edge
+    rtc.start_sqw()
+    start_timer()
     
     #connect to the server
     is_connected = server.connect_wifi(ssid, pw)
@@ -382,19 +455,29 @@ def run():
                 is_connected = server.connect_wifi(ssid, pw)
         
         #start the sever loop to continually listen for for connections. Pass in on_loop function to be ran each loop
-        server.start_server_loop(get_colors_for_server, update_colors_from_server, play_rainbow, draw_message_from_server, on_loop, toggle_render_style)
+        server.start_server_loop(get_colors_for_server, update_colors_from_server, play_rainbow, draw_message_from_server, on_loop, toggle_render_style, set_timezone_from_server)
     except Exception as e:
         log.log_exception(e)
+        hist.log_event(hist.EV_CRASH, 0)
         print ("server crashed!!!!")
         print (f"Error: {e}")
     finally:
         #if we get here the main loop exited for some reason.
         print("Resetting!!!!")
+        settings.commit()
+        rtc.wait_idle()
         machine.soft_reset()
 
 state_loops = 0
 def on_loop():
     global clock_state, state_loops
+    rtc.sync()
+    settings.commit_step()
+    rtc.flush_step()
+    # While an animation is running it has the display and watches the button itself.
+    if neo.is_animating():
+        if neo.animate(): return
+        if display_running: schedule_display(1)    # It's done, so put the clock back now.
     if clock_state == ClockStates.BRIGHTNESS:
         check_encoder_for_brightness()
     if clock_state == ClockStates.DIGIT_COLOR:
@@ -445,8 +528,8 @@ def check_encoder_for_brightness():
         while True:  # looping to keep focus on encoder and not miss steps
             if encoderValue != encoder.EncoderResult.NO_CHANGE:
                 change_brightness(encoderValue)
-                neo.render_time(h12, m, s, is_am, digit_color, colon_color, seconds_color, am_color, brightness, render_style)
-                neo.show()
+                neo.set_global_brightness(brightness)
+                neo.show()  # Brightness is applied on the way out, so no need to redraw
                 encoder_loops = 80  # loops 80 times at .01 sleep. So stays in this loop about .8s after the last encoder change
 
             time.sleep(0.01)
@@ -478,8 +561,7 @@ def check_encoder_for_color_changes():
             if encoderValue != encoder.EncoderResult.NO_CHANGE:
                 color, color_state = change_color(color, color_state, encoderValue, encoder_loops)
                 set_current_color(color, color_state)                                
-                neo.render_time(h12, m, s, is_am, digit_color, colon_color, seconds_color, am_color, brightness, render_style)
-                neo.show()
+                draw_clock(digit_color, colon_color)
                 encoder_loops = 80  # loops 80 times at .01 sleep. So stays in this loop about .8s after the last encoder change
 
             time.sleep(0.01)
@@ -508,9 +590,7 @@ def check_encoder_for_render_style():
         while True:  # looping to keep focus on encoder and not miss steps
             if encoderValue != encoder.EncoderResult.NO_CHANGE:
                 toggle_render_style(encoderValue)
-                neo.clear()
-                neo.render_time(h12, m, s, is_am, digit_color, colon_color, seconds_color, am_color, brightness, render_style)
-                neo.show()
+                draw_clock(digit_color, colon_color)
                 encoder_loops = 80  # loops 80 times at .01 sleep. So stays in this loop about .8s after the last encoder change
 
             time.sleep(0.01)
@@ -519,22 +599,31 @@ def check_encoder_for_render_style():
 
             if encoder_loops < 0:
                 print("encoder loop break")
-                save_render_style()
                 start_timer() #re-starts timer
                 break
 
+def draw_clock(digits, colon):
+    '''draws the clock face and the menu light, redrawing only the parts that changed, and shows it'''
+    neo.begin_frame()
+    neo.render_time(h12, m, s, is_am, digits, colon, seconds_color, am_color, render_style)
+    draw_menu_light()
+    neo.end_frame()
+    neo.show()
+
 def draw_menu_light():
     '''draws a singe light showing what menu spot you're on so you know what the dial will do'''
     if clock_state == ClockStates.DIGIT_COLOR:
-        neo.set_color(0, 7, neo.dim_color(digit_color, brightness))
+        row, color = 7, digit_color
     elif clock_state == ClockStates.COLON_COLOR:
-        neo.set_color(0, 6, neo.dim_color(colon_color, brightness))
+        row, color = 6, colon_color
     elif clock_state == ClockStates.SECONDS_COLOR:
-        neo.set_color(0, 5, neo.dim_color(seconds_color, brightness))
+        row, color = 5, seconds_color
     elif clock_state == ClockStates.AM_COLOR:
-        neo.set_color(0, 4, neo.dim_color(am_color, brightness))
+        row, color = 4, am_color
     elif clock_state == ClockStates.RENDER_STYLE:
-        neo.set_color(0, 3, neo.dim_color(neo.c_blue, brightness))    
+        row, color = 3, neo.c_blue
+    else: return
+    neo.region("menu", 0, row, 0, row, (row, color), neo.set_color, 0, row, color)
 def get_current_color():
     '''returns the color we are modifying based on what state we are in'''
     if clock_state == ClockStates.DIGIT_COLOR:
@@ -563,9 +652,12 @@ def set_current_color(color, color_state):
         am_color_state = color_state
         
 def save_colors():
-    hist.write_colors(digit_color, digit_color_state, colon_color, colon_color_state, seconds_color, seconds_color_state, am_color, am_color_state)
+    settings.change("digit_color", (digit_color, digit_color_state))
+    settings.change("colon_color", (colon_color, colon_color_state))
+    settings.change("seconds_color", (seconds_color, seconds_color_state))
+    settings.change("am_color", (am_color, am_color_state))
 def save_brightness():
-    hist.write_brightness(brightness)
+    settings.change("brightness", brightness)
 def change_color(color, color_state, direction, encoder_loops):
     r, g, b = color
     last_state = color_state
@@ -642,14 +734,17 @@ def set_and_go():
     ap_ssid, bssid, chan, signal, _, _ = ap
     print("Found AP.  Name=%s, Chan=%d, Signal=%d, PW=%s" % (ap_ssid, chan, signal, pw))
     ntp.connect(ssid, pw)
+    t0 = time.ticks_ms()
     t_utc = ntp.ntp()
     if t_utc is None:
         print("Unable to get NTP time.  Abort.")
         return
+    latency = time.ticks_diff(time.ticks_ms(), t0)
+    offset = rtc.utc_now() - t_utc
     t_tuple = time.localtime(t_utc)
     print("Setting UTC Time to = %s" % (str(t_tuple)))
     rtc.set_time(t_tuple)
-    hist.time_check(t_utc)
+    hist.time_check(t_utc, offset, latency)
     run()
 
 
@@ -662,6 +757,7 @@ def update_colors_from_server(values):
     am_color = tuple(map(int, values["ampm_color"]))
     b =float(values["brightness"])
     brightness = b
+    neo.set_global_brightness(brightness)
     print(f"digit color = {digit_color}, brightness (local) = {b} brightness (global) {brightness}!!!!!!!!")
     
     print("Got a color update from the server: ", values)
@@ -676,15 +772,13 @@ def get_colors_for_server():
     return (digit_color, colon_color, seconds_color, am_color, brightness, get_time_string(), time_object)
     
 def play_rainbow():
-    stop_timer()
-    neo.rainbow_animation(600, 0.93, brightness)
-    start_timer()
+    neo.play(neo.rainbow_frames(600, 0.93))
+    start_timer() # So the clock comes back when it's done.
     
 def show_ip():
-    stop_timer()
-    if is_connected: neo.show_wifi_ok(ip)
-    else: neo.scroll_text("  " + access_point.scroll_text, neo.dim_color(digit_color, brightness), .005)
-    start_timer()
+    if is_connected: neo.play(neo.wifi_ok_frames(ip))
+    else: neo.play(neo.scroll_frames("  " + access_point.scroll_text, digit_color, 5))
+    start_timer() # So the clock comes back when it's done.
     
 def get_time_string():
     if is_am: am_or_pm = "am"
@@ -692,18 +786,30 @@ def get_time_string():
     return f"{h12}:{m:02d}:{s:02d} {am_or_pm}"
 
 def draw_message_from_server(message, color, isLarge):
-    stop_timer()
-    neo.scroll_text(message,neo.dim_color(color, brightness), .05, isLarge)
-    start_timer()
+    # A new message replaces whatever is playing.
+    neo.play(neo.scroll_frames(message, color, 50, isLarge), preempt=True)
+    start_timer() # So the clock comes back when it's done.
+def set_timezone_from_server(tz):
+    ''' Switches to a new POSIX TZ string and saves it.  Returns False if it isn't valid.'''
+    try:
+        th.set_timezone(tz)
+    except ValueError as e:
+        print("Bad time zone: ", e)
+        return False
+    settings.change("timezone", tz)
+    start_timer() # Show the new time right away.
+    return True
+
 def save_render_style():
-    hist.write_render_style(render_style)
+    settings.change("render_style", render_style)
     
 def toggle_render_style(is_up = encoder.EncoderResult.UP):
     global render_style
     if is_up == encoder.EncoderResult.UP: render_style += 1;
     else: render_style -=1;
-    if render_style >= len(RenderStyles.NAMES): render_style = 0
-    if render_style < 0: render_style = len(RenderStyles.NAMES) - 1
+    if render_style >= RenderStyles.count(): render_style = 0
+    if render_style < 0: render_style = RenderStyles.count() - 1
+    print("Render style: ", RenderStyles.NAMES[render_style])
     save_render_style()
     
     
\ No newline at end of file
@@ -1,6 +1,7 @@
 from machine import Pin
 from neopixel import NeoPixel
 #from main import RenderStyles
+from array import array
 import alphabet
 import time
 import ntptime as ntp
@@ -16,7 +17,7 @@ import render_styles as RenderStyles
 # c_black = (0, 0, 0)
 # c_white = (255, 255, 255)
 
-# Brightness Reduction
+# Brightness Reduction.  Applied to the whole display by show(), see set_global_brightness().
 b = .03
 c_red   = (255, 0, 0)
 c_green = (0, 255, 0)
@@ -32,19 +33,22 @@ N = 256
 PANEL_WIDTH = 32
 PANEL_HEIGHT = 8
 CHAR_WIDTH = 6
+COL_BYTES = PANEL_HEIGHT * 3
 
-def show():
-    np.write()
-
-def solid(c):
-    for i in range(N): np[i] = c
-    
-def clear():
-    solid((0,0,0))
-    
-def dim_color(color, dimRatio):
-    r, g, b = color
-    return (int(r*dimRatio), int(g*dimRatio), int(b*dimRatio))
+# Frame Buffer
+# All drawing is done into fb, a flat bytearray holding 3 bytes per pixel in GRB
+# order (the byte order the WS2812B strip wants).  The pixels are stored column by
+# column from the left of the panel to the right, and each column from the bottom
+# row to the top row.  So pixel (x, y) starts at fb[(x * PANEL_HEIGHT + y) * 3], and
+# every column of the display is one contiguous 24 byte slice of the buffer.
+#
+# The serpentine wiring of the strip is dealt with in just one place: show() uses
+# the pixel_offset table (built once, below) to copy the frame buffer into the
+# NeoPixel buffer in strip order, and then writes the whole strip in one go.
+fb = bytearray(3 * N)
+fbmv = memoryview(fb)
+scratch = bytearray(3 * N)    # Work space for copies where source and destination overlap
+scratchmv = memoryview(scratch)
 
 def get_xy_index(x, y):
     ''' Returns the index in the neo pixel strip, given an (x,y) location, where (0,0) is the
@@ -61,11 +65,357 @@ def get_xy_index(x, y):
     else:             n += y
     return n
 
+def build_pixel_offsets():
+    ''' Returns a table that gives, for each pixel in the strip, the offset of that
+    pixel in the frame buffer.  Only needs to be done once.'''
+    table = array('H', bytes(2 * N))
+    for x in range(PANEL_WIDTH):
+        for y in range(PANEL_HEIGHT):
+            table[get_xy_index(x, y)] = (x * PANEL_HEIGHT + y) * 3
+    return table
+
+pixel_offset = build_pixel_offsets()
+
+# Output Stage
+# The frame buffer holds colors at full intensity.  Brightness and gamma are applied
+# only as the frame is copied out to the strip, through out_lut: a 256 entry table that
+# maps a color value in the frame buffer to the value sent to the LEDs.  The table is
+# rebuilt only when the brightness or gamma changes.
+b_lut = None          # (brightness, gamma) that out_lut was built for.
+gamma = 1.0           # 1.0 gives the same linear dimming that dim_color() does.
+out_lut = bytearray(256)
+lut_changed = True    # True if out_lut changed since the strip was last written.
+raw_lut = bytearray(range(256))   # Passes colors through as they are, for show(raw=True).
+shown_raw = False     # True if the strip was last written with raw_lut.
+
+def build_lut():
+    ''' Rebuilds the output table for the current brightness and gamma, if needed.'''
+    global b_lut, lut_changed
+    if b_lut == (b, gamma): return
+    for i in range(256):
+        if gamma == 1.0: v = int(i * b)
+        else: v = int(255.0 * math.pow(i / 255.0, gamma) * b)
+        if v > 255: v = 255
+        out_lut[i] = v
+    b_lut = (b, gamma)
+    lut_changed = True
+
+build_lut()
+
+def set_gamma(g):
+    ''' Sets the gamma used on the way out to the strip.  1.0 turns gamma correction off.'''
+    global gamma
+    gamma = g
+    build_lut()
+
+def show(raw=False):
+    ''' Copies the frame buffer into the strip (in strip order) through the brightness
+    table, and writes it out.  Does nothing if neither the frame buffer nor the
+    brightness has changed since the last time it was shown.  With raw, the colors go
+    out as they are, without the brightness.'''
+    global shown_valid, frames_shown, frames_skipped, lut_changed, shown_raw
+    if shown_valid and not lut_changed and raw == shown_raw and fb == last_shown:
+        frames_skipped += 1
+        return
+    last_shown[:] = fb
+    shown_valid = True
+    lut_changed = False
+    shown_raw = raw
+    frames_shown += 1
+    buf = np.buf
+    po = pixel_offset
+    lut = raw_lut if raw else out_lut
+    src = fb
+    j = 0
+    for i in range(N):
+        o = po[i]
+        buf[j] = lut[src[o]]
+        buf[j + 1] = lut[src[o + 1]]
+        buf[j + 2] = lut[src[o + 2]]
+        j += 3
+    np.write()
+
+def fill_columns(x0, x1, color):
+    ''' Fills the columns x0 through x1 (inclusive) with one color.'''
+    if x0 < 0: x0 = 0
+    if x1 > PANEL_WIDTH - 1: x1 = PANEL_WIDTH - 1
+    if x0 > x1: return
+    a = x0 * COL_BYTES
+    end = (x1 + 1) * COL_BYTES
+    r, g, b = color
+    fb[a] = g
+    fb[a + 1] = r
+    fb[a + 2] = b
+    # Keep doubling the filled part, so that the whole panel takes 9 copies.
+    n = 3
+    while a + n < end:
+        k = n
+        if a + n + k > end: k = end - a - n
+        fbmv[a + n:a + n + k] = fbmv[a:a + k]
+        n += k
+
+def fill(color):
+    ''' Fills the whole frame buffer with one color.'''
+    fill_columns(0, PANEL_WIDTH - 1, color)
+    invalidate()
+
+def fill_rect(x0, y0, x1, y1, color):
+    ''' Fills the rectangle with corners (x0, y0) and (x1, y1) (inclusive) with one color.'''
+    if x0 < 0: x0 = 0
+    if y0 < 0: y0 = 0
+    if x1 > PANEL_WIDTH - 1: x1 = PANEL_WIDTH - 1
+    if y1 > PANEL_HEIGHT - 1: y1 = PANEL_HEIGHT - 1
+    if x0 > x1 or y0 > y1: return
+    if y0 == 0 and y1 == PANEL_HEIGHT - 1:
+        fill_columns(x0, x1, color)
+        return
+    # Color the span of the first column, then copy that span to the other columns.
+    r, g, b = color
+    a = (x0 * PANEL_HEIGHT + y0) * 3
+    n = (y1 - y0 + 1) * 3
+    for o in range(a, a + n, 3):
+        fb[o] = g
+        fb[o + 1] = r
+        fb[o + 2] = b
+    d = a + COL_BYTES
+    for x in range(x0 + 1, x1 + 1):
+        fbmv[d:d + n] = fbmv[a:a + n]
+        d += COL_BYTES
+
+def solid(c):
+    fill(c)
+    
+def clear():
+    solid((0,0,0))
+
+def copy_columns(x_dst, x_src, ncols):
+    ''' Copies ncols whole columns, starting at x_src, over to x_dst.  The two
+    areas may overlap.  Columns that would land off the panel are dropped.'''
+    if x_dst < 0:
+        x_src -= x_dst
+        ncols += x_dst
+        x_dst = 0
+    if x_dst + ncols > PANEL_WIDTH: ncols = PANEL_WIDTH - x_dst
+    if x_src < 0 or x_src + ncols > PANEL_WIDTH or ncols <= 0: return
+    a = x_src * COL_BYTES
+    d = x_dst * COL_BYTES
+    n = ncols * COL_BYTES
+    scratchmv[0:n] = fbmv[a:a + n]
+    fbmv[d:d + n] = scratchmv[0:n]
+
+def blit(x_dst, src, x_src, ncols):
+    ''' Copies ncols columns out of another frame buffer laid out like fb (24 bytes per
+    column), starting at column x_src of src, onto the panel at column x_dst.'''
+    if x_dst < 0:
+        x_src -= x_dst
+        ncols += x_dst
+        x_dst = 0
+    if x_dst + ncols > PANEL_WIDTH: ncols = PANEL_WIDTH - x_dst
+    if ncols <= 0: return
+    a = x_src * COL_BYTES
+    d = x_dst * COL_BYTES
+    n = ncols * COL_BYTES
+    fbmv[d:d + n] = memoryview(src)[a:a + n]
+
+def blit_column(x, mask, color, y0=0):
+    ''' Sets the pixels of column x that are marked by the bits in mask, where bit 0
+    is row y0, bit 1 is row y0 + 1, and so on.  Other pixels are left alone.'''
+    if x < 0 or x >= PANEL_WIDTH: return
+    if y0 < 0:
+        mask >>= -y0
+        y0 = 0
+    r, g, b = color
+    o = (x * PANEL_HEIGHT + y0) * 3
+    end = (x + 1) * COL_BYTES
+    while mask and o < end:
+        if mask & 1:
+            fb[o] = g
+            fb[o + 1] = r
+            fb[o + 2] = b
+        mask >>= 1
+        o += 3
+    
+# Dirty Region Rendering
+# The clock face is built from named regions.  A region is a rectangle on the panel,
+# a key that describes what is drawn there (the character and color, for example), and
+# the function that draws it.  Between begin_frame() and end_frame() the regions are
+# only collected.  end_frame() then compares each key to the one used in the previous
+# frame, and only clears and redraws the regions that changed.  Since clearing a region
+# wipes out anything else that overlaps it, overlapping regions are redrawn as well.
+#
+# Anything that draws on the panel outside of this scheme (animations, status screens,
+# scrolling text) must call invalidate(), so that the next frame is redrawn in full.
+# fill(), solid(), clear() and the shift functions do this for you.
+
+frame_regions = None   # Regions collected for the frame being built, or None.
+last_regions = {}      # name -> (rectangle, key) for the regions now in the frame buffer.
+face_valid = False     # False if the frame buffer no longer holds the regions in last_regions.
+last_shown = bytearray(3 * N)   # Copy of the frame buffer that was last written to the strip.
+shown_valid = False
+
+frames_shown = 0       # Number of times the strip was written.
+frames_skipped = 0     # Number of show() calls skipped because nothing had changed.
+pixels_touched = 0     # Number of pixels cleared and redrawn by end_frame().
+
+def invalidate():
+    ''' Marks the clock face as damaged, so that the next frame redraws all regions.'''
+    global face_valid
+    face_valid = False
+
+def begin_frame():
+    ''' Starts collecting regions for a new frame.'''
+    global frame_regions
+    frame_regions = []
+
+def region(name, x0, y0, x1, y1, key, draw, *args):
+    ''' Adds a region to the frame being built.  draw(*args) must only draw inside of
+    the rectangle (x0, y0)-(x1, y1).  If no frame is being built, the region is drawn
+    right away.'''
+    if frame_regions is None:
+        draw(*args)
+        invalidate()
+        return
+    frame_regions.append((name, (x0, y0, x1, y1), key, draw, args))
+
+def overlaps(ra, rb):
+    ''' Returns True if two rectangles, given as (x0, y0, x1, y1), have a pixel in common.'''
+    return ra[0] <= rb[2] and rb[0] <= ra[2] and ra[1] <= rb[3] and rb[1] <= ra[3]
+
+def end_frame():
+    ''' Redraws the regions of the frame being built that have changed since the
+    last frame.  Doesn't show.'''
+    global frame_regions, last_regions, face_valid, pixels_touched
+    regions = frame_regions
+    frame_regions = None
+    if regions is None: return
+    redraw = [False] * len(regions)
+    if not face_valid:
+        fill_columns(0, PANEL_WIDTH - 1, c_black)
+        pixels_touched += N
+        for i in range(len(regions)): redraw[i] = True
+    else:
+        dirty = []
+        seen = {}
+        for i in range(len(regions)):
+            name, rect, key, _, _ = regions[i]
+            seen[name] = True
+            old = last_regions.get(name)
+            if old is None or old[0] != rect or old[1] != key:
+                if old is not None and old[0] != rect: dirty.append(old[0])
+                dirty.append(rect)
+                redraw[i] = True
+        for name in last_regions:
+            if name not in seen: dirty.append(last_regions[name][0])
+        # Pull in the regions that share pixels with the ones being cleared.
+        changed = True
+        while changed:
+            changed = False
+            for i in range(len(regions)):
+                if redraw[i]: continue
+                rect = regions[i][1]
+                for d in dirty:
+                    if overlaps(rect, d):
+                        redraw[i] = True
+                        dirty.append(rect)
+                        changed = True
+                        break
+        for x0, y0, x1, y1 in dirty:
+            fill_rect(x0, y0, x1, y1, c_black)
+            pixels_touched += (x1 - x0 + 1) * (y1 - y0 + 1)
+    new_regions = {}
+    for i in range(len(regions)):
+        name, rect, key, draw, args = regions[i]
+        if redraw[i]: draw(*args)
+        new_regions[name] = (rect, key)
+    last_regions = new_regions
+    face_valid = True
+
+def get_render_stats():
+    ''' Returns the display work counters as a dictionary.'''
+    return {"frames_shown": frames_shown, "frames_skipped": frames_skipped, "pixels_touched": pixels_touched,
+            "layer_hits": layer_hits, "layer_misses": layer_misses}
+
+def reset_render_stats():
+    global frames_shown, frames_skipped, pixels_touched, frame_ticks, deadline_misses, frame_log_next
+    global layer_hits, layer_misses
+    frames_shown = 0
+    frames_skipped = 0
+    pixels_touched = 0
+    layer_hits = 0
+    layer_misses = 0
+    frame_ticks = 0
+    deadline_misses = 0
+    frame_log_next = 0
+
+# Frame Timing
+# The display scheduler in main.py logs every tick here, and animate() every animation
+# frame: how late it started compared to when it was due, and how long it took.  The last FRAME_LOG_SIZE ticks are kept in a ring
+# buffer, which get_frame_stats() sums up.  Jitter is the average distance of the lateness
+# from its mean.
+
+FRAME_LOG_SIZE = 64
+MISS_MS = 10                                   # Starting later than this misses the deadline.
+frame_late = array('i', [0] * FRAME_LOG_SIZE)  # ms
+frame_work = array('i', [0] * FRAME_LOG_SIZE)  # us
+frame_log_next = 0
+frame_ticks = 0
+deadline_misses = 0
+
+def record_frame(late_ms, work_us):
+    global frame_log_next, frame_ticks, deadline_misses
+    frame_late[frame_log_next] = late_ms
+    frame_work[frame_log_next] = work_us
+    frame_log_next = (frame_log_next + 1) % FRAME_LOG_SIZE
+    frame_ticks += 1
+    if late_ms > MISS_MS: deadline_misses += 1
+
+def get_frame_stats():
+    ''' Returns the frame timing for the last FRAME_LOG_SIZE ticks as a dictionary.'''
+    n = min(frame_ticks, FRAME_LOG_SIZE)
+    stats = {"ticks": frame_ticks, "misses": deadline_misses, "late_avg_ms": 0, "late_max_ms": 0,
+             "jitter_ms": 0, "work_avg_us": 0, "work_max_us": 0}
+    if n == 0: return stats
+    late = frame_late[:n]
+    work = frame_work[:n]
+    mean = sum(late) / n
+    stats["late_avg_ms"] = mean
+    stats["late_max_ms"] = max(late)
+    stats["jitter_ms"] = sum([abs(x - mean) for x in late]) / n
+    stats["work_avg_us"] = sum(work) // n
+    stats["work_max_us"] = max(work)
+    return stats
+
+def dim_color(color, dimRatio):
+    r, g, b = color
+    return (int(r*dimRatio), int(g*dimRatio), int(b*dimRatio))
+
 def set_color(x, y, color):
     ''' Set color of one pixel at the given x,y location on the grid, where 0,0 is the bottom left.'''
     #print(f"color r {color[0]}, g {color[1]}, b {color[2]}")
-    i = get_xy_index(x, y)
-    if i >= 0: np[i] = color
+    if x < 0 or x >= PANEL_WIDTH or y < 0 or y >= PANEL_HEIGHT: return
+    o = (x * PANEL_HEIGHT + y) * 3
+    fb[o] = color[1]
+    fb[o + 1] = color[0]
+    fb[o + 2] = color[2]
+
+def get_color(x, y):
+    ''' Returns the color of one pixel in the frame buffer as an (r, g, b) tuple.'''
+    if x < 0 or x >= PANEL_WIDTH or y < 0 or y >= PANEL_HEIGHT: return c_black
+    o = (x * PANEL_HEIGHT + y) * 3
+    return (fb[o + 1], fb[o], fb[o + 2])
+
+def set_index(i, color):
+    ''' Set color of one pixel, given its index along the strip.'''
+    if i < 0 or i >= N: return
+    o = pixel_offset[i]
+    fb[o] = color[1]
+    fb[o + 1] = color[0]
+    fb[o + 2] = color[2]
+
+def get_index(i):
+    ''' Returns the color of one pixel, given its index along the strip.'''
+    o = pixel_offset[i % N]
+    return (fb[o + 1], fb[o], fb[o + 2])
         
 def my_abs(x):
     if x >= 0: return x
@@ -133,25 +483,21 @@ def counter():
         str_mins  = "%02d" % mins
         solid(c_black)
         c = c_green
-        alphabet.render(np, 2, c, str_hours[0])
-        alphabet.render(np, 9, c, str_hours[1])
-        alphabet.render(np, 14, c, ":")
-        alphabet.render(np, 19, c, str_mins[0])
-        alphabet.render(np, 26, c, str_mins[1])
+        alphabet.render(2, c, str_hours[0])
+        alphabet.render(9, c, str_hours[1])
+        alphabet.render(14, c, ":")
+        alphabet.render(19, c, str_mins[0])
+        alphabet.render(26, c, str_mins[1])
         show()
         time.sleep(0.25)
          
-#     SHORT_SECOND_LINE = 0
-#     LONG_SECOND_LINE = 1
-#     NUMBERED_SECONDS = 2
-#     BORRING_MODE = 3
-         
-def render_time(hours, mins, sec, isAM, color_digits, color_colon, seconds_color, am_color, brightness, render_style = RenderStyles.NUMBERED_SECONDS):
-    ''' Writes the time digits to the display. Doesn't clear or show.'''
-    if render_style == RenderStyles.BORING_MODE:
-        digit_column = [3,9,13,17,23]
-    else: digit_column = [0,5,9,13,19]
-    
+def render_time(hours, mins, sec, isAM, color_digits, color_colon, seconds_color, am_color, render_style = RenderStyles.NUMBERED_SECONDS):
+    ''' Writes the time digits to the display. Doesn't clear or show.  When called between
+    begin_frame() and end_frame(), only the parts of the face that changed are redrawn.
+    The layout comes from the render style registry, see render_styles.py.'''
+    layout = RenderStyles.get(render_style)
+    digit_column = layout.digit_columns
+
     err = False
     if hours < 0 or hours > 12: err = True
     if mins < 0 or mins > 59: err = True
@@ -161,43 +507,91 @@ def render_time(hours, mins, sec, isAM, color_digits, color_colon, seconds_color
     else:
         str_hours = "%02d" % hours
         str_mins  = "%02d" % mins
-    if hours >= 10 or render_style == RenderStyles.BORING_MODE: alphabet.render(np, digit_column[0], dim_color(color_digits, brightness), str_hours[0])
-    
-    alphabet.render(np, digit_column[1], dim_color(color_digits, brightness), str_hours[1])
-    alphabet.render(np, digit_column[2], dim_color(color_colon, brightness), ":")
-    alphabet.render(np, digit_column[3], dim_color(color_digits, brightness), str_mins[0])
-    alphabet.render(np, digit_column[4], dim_color(color_digits, brightness), str_mins[1])
-
-    if render_style == RenderStyles.SHORT_SECOND_LINE:  
-        partialMin = sec/60*7
-        full = int(partialMin)
-        remainderFraction = partialMin-full
-        #Draw Seconds line
-        if(full>0):
-            
-            draw_horz_line(7,25,25+full-1, dim_color(seconds_color, brightness))
-            draw_horz_line(6,25,25+full-1, dim_color(seconds_color, brightness))
-        #Draw partial second 
-        set_color(25+full,7,dim_color(dim_color(seconds_color, brightness), remainderFraction))
-        set_color(25+full,6,dim_color(dim_color(seconds_color, brightness), remainderFraction))
-        draw_am_pm(isAM, am_color, brightness)
-    elif render_style == RenderStyles.LONG_SECOND_LINE:
-        partialMin = sec/60*32
-        full = int(partialMin)
-        remainderFraction = partialMin-full
-        #Draw Seconds line
-        if(full>0):
-            draw_horz_line(7,0,full-1, dim_color(seconds_color, brightness))
-            set_color(full,7,dim_color(dim_color(seconds_color, brightness), remainderFraction))
-        draw_am_pm(isAM, am_color, brightness)
-    elif render_style == RenderStyles.NUMBERED_SECONDS:
-        alphabet.render_char(get_char_at_index(sec,1),25,dim_color(seconds_color, brightness), size='3x5')
-        alphabet.render_char(get_char_at_index(sec,0),29,dim_color(seconds_color, brightness), size='3x5')
+    glyphs = []
+    if hours >= 10 or layout.always_h10: glyphs.append((digit_column[0], color_digits, str_hours[0]))
 
-        
+    glyphs.append((digit_column[1], color_digits, str_hours[1]))
+    glyphs.append((digit_column[2], color_colon, ":"))
+    glyphs.append((digit_column[3], color_digits, str_mins[0]))
+    glyphs.append((digit_column[4], color_digits, str_mins[1]))
+    # The glyphs only use rows 0 to 6.
+    x0 = layout.digits_x0
+    x1 = layout.digits_x1
+    key = (render_style, hours, mins, color_digits, color_colon)
+    region("hhmm", x0, 0, x1, LAYER_ROWS - 1, key, draw_hhmm, key, x0, x1, glyphs)
+
+    for name, (x0, y0, x1, y1) in layout.decorations:
+        region(name, x0, y0, x1, y1, color_colon, fill_rect, x0, y0, x1, y1, color_colon)
+
+    if layout.seconds != RenderStyles.SECONDS_NONE:
+        x0, y0, x1, y1 = layout.seconds_rect
+        key = (render_style, sec, seconds_color)
+        if layout.seconds == RenderStyles.SECONDS_BAR:
+            region("sec", x0, y0, x1, y1, key, draw_seconds_bar, layout, sec, seconds_color)
+        else:
+            region("sec", x0, y0, x1, y1, key, draw_numbered_seconds, sec, seconds_color, x0)
+    if layout.ampm:
+        region("ampm", 25, 0, 31, 2, (isAM, am_color), draw_am_pm, isAM, am_color)
+
+# Minute Layer
+# Hours, colon and minutes only change once a minute, or with a color or style change, so
+# render_time() draws them as one region and keeps the rendered pixels (rows 0 to 6) for
+# the last few keys.  When that region has to be drawn again with the same key, after an
+# animation or when the digits blink between two colors, the pixels are copied back
+# instead of rendering the glyphs.  Brightness is applied by show() on the way out, so it
+# doesn't need to be part of the key.
+
+LAYER_ROWS = 7
+LAYER_BYTES = LAYER_ROWS * 3
+LAYER_CACHE_SIZE = 2
+layer_keys = [None] * LAYER_CACHE_SIZE
+layer_pixels = [bytearray(PANEL_WIDTH * LAYER_BYTES) for i in range(LAYER_CACHE_SIZE)]
+layer_next = 0         # Cache slot to fill on the next miss.
+layer_hits = 0
+layer_misses = 0
+
+def draw_hhmm(key, x0, x1, glyphs):
+    ''' Draws the hours and minutes, copying them from the layer cache if it has them.
+    glyphs is a list of (column, color, character).'''
+    global layer_next, layer_hits, layer_misses
+    for i in range(LAYER_CACHE_SIZE):
+        if layer_keys[i] == key:
+            layer_hits += 1
+            copy_layer(layer_pixels[i], x0, x1, True)
+            return
+    layer_misses += 1
+    for column, color, c in glyphs: alphabet.render(column, color, c)
+    i = layer_next
+    layer_next = (i + 1) % LAYER_CACHE_SIZE
+    copy_layer(layer_pixels[i], x0, x1, False)
+    layer_keys[i] = key
+
+def copy_layer(layer, x0, x1, to_fb):
+    ''' Copies rows 0 to 6 of columns x0 to x1 between a layer and the frame buffer.'''
+    lmv = memoryview(layer)
+    for x in range(x0, x1 + 1):
+        a = x * COL_BYTES
+        l = x * LAYER_BYTES
+        if to_fb: fbmv[a:a + LAYER_BYTES] = lmv[l:l + LAYER_BYTES]
+        else: lmv[l:l + LAYER_BYTES] = fbmv[a:a + LAYER_BYTES]
+
+def clear_layer_cache():
+    for i in range(LAYER_CACHE_SIZE): layer_keys[i] = None
+
+def draw_seconds_bar(layout, sec, seconds_color):
+    ''' Draws the seconds bar of a layout from its tables.'''
+    if sec < 0 or sec > 59: return   # No valid time
+    x0, y0, x1, y1 = layout.seconds_rect
+    full = layout.bar_full[sec]
+    #Draw Seconds line
+    if full > 0: fill_rect(x0, y0, x0 + full - 1, y1, seconds_color)
+    #Draw partial second
+    fill_rect(x0 + full, y0, x0 + full, y1, dim_color(seconds_color, layout.bar_frac[sec]))
+
+def draw_numbered_seconds(sec, color, x=25):
+    alphabet.render_char(get_char_at_index(sec,1),x,color, size='3x5')
+    alphabet.render_char(get_char_at_index(sec,0),x + 4,color, size='3x5')
 
-    
-    
 def get_char_at_index(number, index):
     # Convert the number to a string
     number_str = str(number)
@@ -213,65 +607,69 @@ def get_char_at_index(number, index):
         # Index out of range
         return '0'
     
-def draw_am_pm(isAM, am_color, brightness):
+def draw_am_pm(isAM, am_color):
    #Change the 'a' to a 'p' if it's 'pm'
     if isAM:
         #Draw 'a'
-        draw_horz_line(0, 25, 27, dim_color(am_color, brightness))
-        draw_horz_line(1, 25, 27, dim_color(am_color, brightness))
-        draw_horz_line(2, 26, 27, dim_color(am_color, brightness))
+        draw_horz_line(0, 25, 27, am_color)
+        draw_horz_line(1, 25, 27, am_color)
+        draw_horz_line(2, 26, 27, am_color)
     else:
         #Draw 'p'
-        draw_horz_line(1, 25, 27, dim_color(am_color, brightness))
-        draw_horz_line(2, 25, 27, dim_color(am_color, brightness))
-        set_color(25, 0, dim_color(am_color, brightness)) 
+        draw_horz_line(1, 25, 27, am_color)
+        draw_horz_line(2, 25, 27, am_color)
+        set_color(25, 0, am_color) 
     #Draw 'm'
-    draw_vert_line(29, 0, 2, dim_color(am_color, brightness))
-    draw_vert_line(30, 1, 2, dim_color(am_color, brightness))
-    draw_vert_line(31, 0, 2, dim_color(am_color, brightness))
+    draw_vert_line(29, 0, 2, am_color)
+    draw_vert_line(30, 1, 2, am_color)
+    draw_vert_line(31, 0, 2, am_color)
 def show_wifi_ok(ip_address, color_wifi=c_blue, color_ok=c_green):
-    ''' Writes "wifi ok" to the display. Doesn't clear or show.'''
+    ''' Shows "wifi ok", then scrolls the ip address.  Blocks till done.'''
+    run_animation(wifi_ok_frames(ip_address, color_wifi, color_ok))
+
+def wifi_ok_frames(ip_address, color_wifi=c_blue, color_ok=c_green):
+    ''' Animation for show_wifi_ok().'''
     clear()
-    alphabet.render(np, 0, dim_color(color_wifi, b), "w")
-    alphabet.render(np, 5, dim_color(color_wifi, b), "i")
-    alphabet.render(np, 9, dim_color(color_wifi, b), "f")
-    alphabet.render(np, 13, dim_color(color_wifi, b), "i")
-    alphabet.render(np, 21, dim_color(color_ok, b), "o")
-    alphabet.render(np, 27, dim_color(color_ok, b), "k")
+    alphabet.render(0, color_wifi, "w")
+    alphabet.render(5, color_wifi, "i")
+    alphabet.render(9, color_wifi, "f")
+    alphabet.render(13, color_wifi, "i")
+    alphabet.render(21, color_ok, "o")
+    alphabet.render(27, color_ok, "k")
     show()
-    time.sleep(.5)
+    yield 500
     
-    scroll_text(ip_address,dim_color(color_wifi, b), .005)
+    yield from scroll_frames(ip_address, color_wifi, 5)
     
 def show_no_wifi(color_no=c_red, color_wifi=c_blue):
     ''' Writes "NO wifi" to the display. Doesn't clear or show.'''
     clear()
-    alphabet.render(np,  0, dim_color(color_no, b),   "N")
-    alphabet.render(np,  6, dim_color(color_no, b),   "O")
-    alphabet.render(np, 16, dim_color(color_wifi, b), "w")
-    alphabet.render(np, 21, dim_color(color_wifi, b), "i")
-    alphabet.render(np, 25, dim_color(color_wifi, b), "f")
-    alphabet.render(np, 29, dim_color(color_wifi, b), "i")
+    alphabet.render( 0, color_no,   "N")
+    alphabet.render( 6, color_no,   "O")
+    alphabet.render(16, color_wifi, "w")
+    alphabet.render(21, color_wifi, "i")
+    alphabet.render(25, color_wifi, "f")
+    alphabet.render(29, color_wifi, "i")
     show()
     
 def show_ntp_ok():
     ''' Write "NTP OK" to the dispaly '''
     clear()
-    alphabet.new_render("N", 0, dim_color(c_blue,b))
-    alphabet.new_render("T", 6, dim_color(c_blue,b))
-    alphabet.new_render("P", 12, dim_color(c_blue,b))
-    alphabet.new_render("O", 20, dim_color(c_green,b))
-    alphabet.new_render("k", 26, dim_color(c_green,b))
+    alphabet.new_render("N", 0, c_blue)
+    alphabet.new_render("T", 6, c_blue)
+    alphabet.new_render("P", 12, c_blue)
+    alphabet.new_render("O", 20, c_green)
+    alphabet.new_render("k", 26, c_green)
     show()
     
 def show_no_ntp():
     ''' Writes "NO NTP" to the display.'''
     clear()
-    alphabet.new_render("N", 0, dim_color(c_red,b))
-    alphabet.new_render("O", 6, dim_color(c_red,b))
-    alphabet.new_render("N", 14, dim_color(c_blue,b))
-    alphabet.new_render("T", 20, dim_color(c_blue,b))
-    alphabet.new_render("P", 26, dim_color(c_blue,b))
+    alphabet.new_render("N", 0, c_red)
+    alphabet.new_render("O", 6, c_red)
+    alphabet.new_render("N", 14, c_blue)
+    alphabet.new_render("T", 20, c_blue)
+    alphabet.new_render("P", 26, c_blue)
     show()
     
 def fill_pattern(pat, color):
@@ -279,13 +677,17 @@ def fill_pattern(pat, color):
     p0, n, step = pat
     for i in range(n):
         indx = p0 + i*step
-        if indx >= 0 and indx < N: np[indx] = color
+        if indx >= 0 and indx < N: set_index(indx, color)
     
 def startup_animation():
     ''' Runs a quick startup animation. Blocks till done.'''
+    run_animation(startup_frames())
+
+def startup_frames():
+    ''' Animation for startup_animation().'''
     solid((5,5,5))
-    show()
-    time.sleep(0.3)
+    show(raw=True)      # Already dim, the brightness would take it to black.
+    yield 300
     ccs = (c_red, c_blue, c_green)
     square_1 = ((0, 16, 16), (15, 16, 16), (7, 16, 16), (8, 16, 16), (0, 8, 1), (248, 8, 1))
     square_2 = ((14, 15, 16), (17, 15, 16), (9, 15, 16), (22, 15, 16), (9, 6, 1), (241, 6, 1))
@@ -296,12 +698,17 @@ def startup_animation():
         for design in designs:
             solid(c_black)
             for seg in design:
-                fill_pattern(seg, dim_color(color,b))
+                fill_pattern(seg, color)
             show()
-            time.sleep(0.2)
+            yield 200
             
-def rainbow_animation(loops=50, dim_amount = .93, initial_brightness=0.1, speed=56):
-    '''Runs a rainbow animation with shifting and dimming effects. Blocks until complete.'''
+def rainbow_animation(loops=50, dim_amount = .93, initial_brightness=1.0, speed=56):
+    '''Runs a rainbow animation with shifting and dimming effects. Blocks until complete.
+    initial_brightness is relative to the global brightness.'''
+    run_animation(rainbow_frames(loops, dim_amount, initial_brightness, speed))
+
+def rainbow_frames(loops=50, dim_amount = .93, initial_brightness=1.0, speed=56):
+    ''' Animation for rainbow_animation().  A button press cuts the shifting short.'''
     
     # Initialize animation
     clear()
@@ -323,6 +730,7 @@ def rainbow_animation(loops=50, dim_amount = .93, initial_brightness=0.1, speed=
             break
     
     show()
+    yield 0
     
     # Shift horizontally animation
     i = 0
@@ -331,6 +739,7 @@ def rainbow_animation(loops=50, dim_amount = .93, initial_brightness=0.1, speed=
     while True:
         shift_horizontally()
         show()
+        yield 0
         i += 1
         if i > loops or encoder.did_button_press():
             break
@@ -342,6 +751,7 @@ def rainbow_animation(loops=50, dim_amount = .93, initial_brightness=0.1, speed=
     while current_brightness > 0.002:
         shift_horizontally()
         show()
+        yield 0
         if fade_out(current_brightness) <= 0:
             break
         current_brightness *= dim_amount
@@ -357,124 +767,238 @@ def blue_square(indx, colon_color = c_blue):
     ''' Shows a blue square to indicate trying to connect to wifi and get time. '''
     solid(c_black)
     square_1 = ((0, 16, 16), (15, 16, 16), (7, 16, 16), (8, 16, 16), (0, 8, 1), (248, 8, 1))
-    for seg in square_1: fill_pattern(seg, dim_color(c_blue,b))
+    for seg in square_1: fill_pattern(seg, c_blue)
     if indx > 0:
         ii = indx % 14
-        np[ii*16 + 19] = dim_color(colon_color, b)
-        np[ii*16 + 20] = dim_color(colon_color, b)
+        set_index(ii*16 + 19, colon_color)
+        set_index(ii*16 + 20, colon_color)
     show()
     
 def shift_pixels_down():
-    '''Shifts pixels down the row of NeoPixels.'''
-    # Create a temporary list to store the shifted colors
-    shifted_pixels = [0] * N
-
-    # Shift the colors down the row
-    for i in range(N):
-        if i < N - 1:
-            shifted_pixels[i] = np[i + 1]
+    '''Shifts every pixel one step back along the strip, with the first pixel wrapping
+    around to the end.  Since the strip snakes up and down the columns, pixels move
+    down the odd columns and up the even ones.'''
+    invalidate()
+    scratchmv[:] = fbmv
+    n = COL_BYTES - 3
+    for x in range(PANEL_WIDTH):
+        a = x * COL_BYTES
+        nxt = ((x + 1) % PANEL_WIDTH) * COL_BYTES   # Start of the next column along the strip
+        if x % 2 == 1:
+            # Strip runs bottom to top here: move down, top pixel comes from the next column.
+            fbmv[a:a + n] = scratchmv[a + 3:a + 3 + n]
+            fbmv[a + n:a + COL_BYTES] = scratchmv[nxt + n:nxt + COL_BYTES]
         else:
-            shifted_pixels[i] = np[0]
-    
-    # Update NeoPixels with the shifted colors
-    for i in range(N):
-        np[i] = shifted_pixels[i]
+            # Strip runs top to bottom here: move up, bottom pixel comes from the next column.
+            fbmv[a + 3:a + COL_BYTES] = scratchmv[a:a + n]
+            fbmv[a:a + 3] = scratchmv[nxt:nxt + 3]
 
 def shift_horizontally(direction=1, shift_amount=16):
     '''Shifts pixels horizontally, moving them over one spot to the right. 16 is default because that would move the pixel up 8 rows and then down the 8 in the next column putting the pixel right next to where it started'''
-    # Create a temporary list to store the shifted colors
-    shifted_pixels = [(0,0,0)] * N
-
-    # Shift the colors by the specified amount to the left
-    for i in range(N):
-        if(i-shift_amount*direction<N): shifted_pixels[i] = np[i - shift_amount* direction]
-    
-    # Update NeoPixels with the shifted colors
-    for i in range(N):
-        np[i] = shifted_pixels[i]
+    # shift_amount counts pixels along the strip.  Moving right wraps around, moving left
+    # (direction=-1) brings in black.  A multiple of 16 is an even number of whole columns,
+    # which run the same way along the strip, so they move with slice copies.  Anything
+    # else turns the columns over, and goes pixel by pixel in strip order.
+    invalidate()
+    k = shift_amount * direction
+    if k == 0: return
+    if k % (2 * PANEL_HEIGHT) != 0:
+        scratchmv[:] = fbmv
+        for i in range(N):
+            o = pixel_offset[i]
+            j = i - k
+            if j >= N:
+                fb[o] = fb[o + 1] = fb[o + 2] = 0
+            else:
+                src = pixel_offset[j % N]
+                fbmv[o:o + 3] = scratchmv[src:src + 3]
+    elif k > 0:
+        n = (k % N) // PANEL_HEIGHT * COL_BYTES
+        total = 3 * N
+        scratchmv[0:n] = fbmv[total - n:total]
+        scratchmv[n:total] = fbmv[0:total - n]
+        fbmv[:] = scratchmv
+    else:
+        ncols = min(-k, N) // PANEL_HEIGHT
+        copy_columns(0, ncols, PANEL_WIDTH - ncols)
+        fill_columns(PANEL_WIDTH - ncols, PANEL_WIDTH - 1, c_black)
         
 def shift_left():
     '''Shifts pixels horizontally left, moving them over one spot to the left. '''
-    # Create a temporary list to store the shifted colors
-    shifted_pixels = [(0,0,0)] * N
-    i = 0
-    shift = 15
-    while(i < N):
-        if i + shift < N: shifted_pixels[i] = np[i + shift]
-        shift -= 2
-        if shift <1: shift = 15
-        i += 1
-    # Update NeoPixels with the shifted colors
-    for i in range(N):
-        np[i] = shifted_pixels[i]
+    invalidate()
+    copy_columns(0, 1, PANEL_WIDTH - 1)
+    fill_columns(PANEL_WIDTH - 1, PANEL_WIDTH - 1, c_black)
+
 def fade_out(brightness):
     '''Fades out NeoPixels with the specified brightness.'''
-    max_color_value = 0
-    
-    # Dim each pixel's color and update NeoPixels
-    for i in range(N):
-        dimmed_color = tuple(int(c * brightness) for c in np[i])
-        np[i] = dimmed_color
-        
-        max_color_value = max(max_color_value, max(dimmed_color))
-        
-    return max_color_value
+    invalidate()
+    # Scale through a table, so each byte is one lookup.
+    table = bytearray(256)
+    for v in range(256): table[v] = int(v * brightness)
+    for i in range(3 * N): fb[i] = table[fb[i]]
+    return max(fb)
 
 def set_global_brightness(brightness):
+    ''' Sets the brightness of everything on the display.  Takes effect at the next show().'''
     global b
     b = brightness
-    
+    build_lut()
+    
+# Scrolling Text
+# A message is rasterized once (see alphabet.rasterize) into a strip of column masks, one
+# byte per column.  Each scroll step then paints a 32 column window of that strip onto the
+# panel, turning each mask into pixels with a small table of ready made columns for the
+# scroll color.  Whatever was on the panel when the scroll started slides off to the left
+# ahead of the text, so the cost of a step does not depend on the length of the message.
+# A looping scroll wraps around the strip without a seam.
+
+scroll_strip = None                  # Column masks of the message, or None when not scrolling.
+scroll_color = c_white
+scroll_loop = False
+scroll_steps = 0                     # Number of steps taken so far.
+scroll_background = bytearray(3 * N) # The panel as it was when the scroll started.
+scroll_columns = [None] * 256        # mask -> 24 bytes of pixels in scroll_color.
+
+def start_scroll(text, color=c_white, isLarge=True, loop=False):
+    ''' Rasterizes text and gets ready to scroll it in from the right.'''
+    global scroll_strip, scroll_color, scroll_loop, scroll_steps
+    if isLarge: scroll_strip = alphabet.rasterize(text, '5x7', CHAR_WIDTH, 0)
+    else:       scroll_strip = alphabet.rasterize(text, '3x5', 4, 1)
+    scroll_color = color
+    scroll_loop = loop
+    scroll_steps = 0
+    scroll_background[:] = fb
+    for i in range(256): scroll_columns[i] = None
+
+def stop_scroll():
+    global scroll_strip
+    scroll_strip = None
+
+def scroll_column(m):
+    ''' Returns the pixels for a column mask in the scroll color.'''
+    p = scroll_columns[m]
+    if p is None:
+        p = bytearray(COL_BYTES)
+        r, g, b = scroll_color
+        o = 0
+        mm = m
+        while mm:
+            if mm & 1:
+                p[o] = g
+                p[o + 1] = r
+                p[o + 2] = b
+            mm >>= 1
+            o += 3
+        scroll_columns[m] = p
+    return p
+
+def scroll_step():
+    ''' Moves the scroll one column to the left.  Doesn't show.  Returns False once the
+    text has gone off the left of the panel (never, for a looping scroll).'''
+    global scroll_steps
+    if scroll_strip is None: return False
+    invalidate()
+    scroll_steps += 1
+    t = scroll_steps
+    n = len(scroll_strip)
+    if not scroll_loop and t > n + PANEL_WIDTH:
+        stop_scroll()
+        return False
+    # Columns still showing what was there before, then one blank column, then text.
+    nbg = PANEL_WIDTH - t
+    if nbg > 0: blit(0, scroll_background, t, nbg)
+    else: nbg = 0
+    zero = scroll_column(0)
+    a = nbg * COL_BYTES
+    for x in range(nbg, PANEL_WIDTH):
+        sc = x - PANEL_WIDTH - 1 + t
+        if sc < 0: p = zero
+        elif scroll_loop: p = scroll_column(scroll_strip[sc % n])
+        elif sc < n: p = scroll_column(scroll_strip[sc])
+        else: p = zero
+        fbmv[a:a + COL_BYTES] = p
+        a += COL_BYTES
+    return True
+
 # Function to scroll text left to right
-def scroll_text(text, color=(5, 5, 5), delay=0.4, isLarge = True):
-    if isLarge:
-        font = '5x7'
-        char_width = 6
-        row = 0
-    else:
-        font = '3x5'
-        char_width = 4
-        row = 1
-    for char in text:
-        w = 0
-        #print(f"Scrolling character: {char}")
-        while w < char_width:
-            shift_left()         
-            alphabet.render_char(char, PANEL_WIDTH - w, color, font, row)  # draws partial letter
-            show()
-            time.sleep(delay)
-            if(encoder.did_button_press()):
-                clear()
-                show()
-                return
-            w += 1
-            #print(f"Shift step {w}/{CHAR_WIDTH}")
-    i = 0
-    while i<PANEL_WIDTH:
-        shift_left()
+def scroll_text(text, color=c_white, delay=0.4, isLarge = True):
+    run_animation(scroll_frames(text, color, int(delay * 1000), isLarge))
+
+def scroll_frames(text, color=c_white, delay_ms=400, isLarge=True):
+    ''' Animation for scroll_text().  A button press stops it and clears the display.'''
+    start_scroll(text, color, isLarge)
+    while scroll_step():
         show()
-        time.sleep(delay)
-        i+=1
-        
-scroll_text_string = ""
-scroll_color = (5,5,5)
-scroll_char_offset = 0
-scroll_char_index = 0
-
-def init_infinite_scroll(text, color=(5,5,5)):
-    global scroll_color, scroll_text_string
-    scroll_text_string = text + "  "
-    scroll_color = color
+        yield delay_ms
+        if(encoder.did_button_press()):
+            stop_scroll()
+            clear()
+            show()
+            return
+
+def init_infinite_scroll(text, color=c_white):
+    start_scroll(text + "  ", color, True, True)
     print(f"init infinite scroll with color: {color} and text: {text}")
     
 def infinite_scroll_on_loop():
-    global scroll_char_index, scroll_char_offset
-    if(scroll_text_string == ""): return
-    if scroll_char_index >= len(scroll_text_string): scroll_char_index = 0
-    char = scroll_text_string[scroll_char_index]
-    shift_left()
-    alphabet.new_render(char, PANEL_WIDTH - scroll_char_offset, scroll_color)  # draws partial letter
+    if scroll_strip is None: return
+    scroll_step()
     show()
-    scroll_char_offset +=1
-    if(scroll_char_offset>=CHAR_WIDTH):
-        scroll_char_offset = 0
-        scroll_char_index += 1
\ No newline at end of file
+
+# Animations
+# Each effect is written as a generator that draws and shows one frame each time it is
+# advanced, then yields how many milliseconds it wants to wait before the next frame.
+# The blocking functions above (rainbow_animation, scroll_text, ...) just run one of these
+# to the end with run_animation().  The main loop can instead hand them to play(), and
+# call animate() every time around; that keeps the web server and the encoder going while
+# the animation runs.  Animations wait in a queue for their turn.  While one is running,
+# it owns the display, so the clock should hold off drawing (see is_animating()).
+
+anim_queue = []        # Animations waiting their turn.
+anim_current = None    # The animation that owns the display, or None.
+anim_due = 0           # ticks_ms() at which the current animation wants its next frame.
+
+def play(anim, preempt=False):
+    ''' Queues an animation to run after the ones already waiting.  With preempt, the
+    running animation and the queue are dropped and this one starts right away.'''
+    if preempt: cancel()
+    anim_queue.append(anim)
+
+def cancel():
+    ''' Stops the running animation and empties the queue.  Leaves the display as it is.'''
+    global anim_current
+    if anim_current is not None: anim_current.close()
+    anim_current = None
+    del anim_queue[:]
+    invalidate()
+
+def is_animating():
+    return anim_current is not None or len(anim_queue) > 0
+
+def animate():
+    ''' Advances the running animation one frame, if its time has come.  Call it often.
+    Returns True while an animation owns the display.'''
+    global anim_current, anim_due
+    now = time.ticks_ms()
+    if anim_current is None:
+        if len(anim_queue) == 0: return False
+        anim_current = anim_queue.pop(0)
+        anim_due = now
+    late = time.ticks_diff(now, anim_due)
+    if late < 0: return True
+    t0 = time.ticks_us()
+    try:
+        delay = next(anim_current)
+    except StopIteration:
+        # Done.  Whatever comes next has to redraw the whole display.
+        anim_current = None
+        invalidate()
+        return is_animating()
+    record_frame(late, time.ticks_diff(time.ticks_us(), t0))
+    anim_due = time.ticks_add(now, delay)
+    return True
+
+def run_animation(anim):
+    ''' Runs an animation from start to finish.  Blocks till done.'''
+    for delay in anim:
+        if delay > 0: time.sleep_ms(delay)
@@ -1,6 +1,65 @@
-SHORT_SECOND_LINE = 0
-LONG_SECOND_LINE = 1
-NUMBERED_SECONDS = 2
-BORING_MODE = 3
+# Render Styles
+# Every way of drawing the clock face is registered here with a Layout.  The geometry is
+# all worked out when the style is registered, so neo.render_time() just looks the layout
+# up and draws from its tables.  The encoder menu and the web page step through the styles
+# in the order they are registered, and NAMES is built from the registry.  To add a style,
+# register one more Layout at the bottom.
 
-NAMES = ["Short Second Line", "Long Second Line", "Seconds", "Boring Mode"]
+SECONDS_NONE = 0     # No seconds indicator.
+SECONDS_BAR = 1      # A line that grows across seconds_rect over the minute.
+SECONDS_DIGITS = 2   # Two small digits in seconds_rect.
+
+class Layout:
+    ''' How one render style lays out the clock face.
+      digit_columns:  left column of the h10, h1, colon, m10 and m1 glyphs
+      always_h10:     draw the tens of hours even when it's 0
+      seconds:        SECONDS_NONE, SECONDS_BAR or SECONDS_DIGITS
+      seconds_rect:   (x0, y0, x1, y1) that the seconds are drawn in
+      ampm:           True to show am/pm in the bottom right corner
+      decorations:    rectangles (x0, y0, x1, y1) that are always lit in the colon color
+      bar_fade_in:    False to leave a bar dark until its first column is fully lit'''
+    def __init__(self, name, digit_columns, always_h10, seconds=SECONDS_NONE, seconds_rect=None, ampm=False, decorations=(), bar_fade_in=True):
+        self.name = name
+        self.digit_columns = tuple(digit_columns)
+        self.always_h10 = always_h10
+        self.digits_x0 = digit_columns[0]
+        self.digits_x1 = digit_columns[4] + 4
+        self.seconds = seconds
+        self.seconds_rect = seconds_rect
+        self.ampm = ampm
+        self.decorations = tuple([("deco%d" % i, d) for i, d in enumerate(decorations)])
+        # For a bar, the number of fully lit columns and the brightness of the next one,
+        # for each second of the minute.
+        self.bar_full = None
+        self.bar_frac = None
+        if seconds == SECONDS_BAR:
+            width = seconds_rect[2] - seconds_rect[0] + 1
+            self.bar_full = bytearray(60)
+            self.bar_frac = [0.0] * 60
+            for sec in range(60):
+                partial = sec/60*width
+                self.bar_full[sec] = int(partial)
+                if int(partial) > 0 or bar_fade_in: self.bar_frac[sec] = partial - int(partial)
+
+styles = []
+NAMES = []
+
+def register(layout):
+    ''' Adds a style and returns its number.'''
+    styles.append(layout)
+    NAMES.append(layout.name)
+    return len(styles) - 1
+
+def count():
+    return len(styles)
+
+def get(style):
+    ''' Returns the layout for a style number.  Unknown numbers get the default style.'''
+    if style < 0 or style >= len(styles): style = NUMBERED_SECONDS
+    return styles[style]
+
+SHORT_SECOND_LINE = register(Layout("Short Second Line", (0, 5, 9, 13, 19), False, SECONDS_BAR, (25, 6, 31, 7), True))
+LONG_SECOND_LINE = register(Layout("Long Second Line", (0, 5, 9, 13, 19), False, SECONDS_BAR, (0, 7, 31, 7), True, bar_fade_in=False))
+NUMBERED_SECONDS = register(Layout("Seconds", (0, 5, 9, 13, 19), False, SECONDS_DIGITS, (25, 0, 31, 4)))
+BORING_MODE = register(Layout("Boring Mode", (3, 9, 13, 17, 23), True))
+BRACKETED = register(Layout("Bracketed", (3, 9, 13, 17, 23), True, SECONDS_BAR, (0, 7, 31, 7), False, ((0, 1, 0, 5), (31, 1, 31, 5)), False))
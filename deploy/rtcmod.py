@@ -10,85 +10,296 @@
 # read and write around the page boundaries.  A page is 32 bytes long,
 # and there are 128 pages in the memory.  For best resultes a read or
 # write should start on a page boundry, and be limited to 32 bytes.
+#
+# Without a machine module (on a PC), the bus, pins and timers come from i2csim, which
+# simulates both chips.
 
-from machine import Pin, I2C, SoftI2C
+try:
+    from machine import Pin, I2C, SoftI2C, Timer
+except ImportError:
+    from i2csim import Pin, I2C, SoftI2C, Timer
 import timehelp as th
+import civil
 import time
 
-i2c = SoftI2C(Pin(5), Pin(4), freq=100_000)         # Software I2C
-#i2c = I2C(0, scl=Pin(5), sda=Pin(4), freq= 100_000)  # Hardware I2C
 rtc_adr    = 0x68
 eeprom_adr = 0x57
 
-last_write_time = None
-delay_start = None
-
-def start_eeprom_delay():
-    ''' Mark a start time to delay further operations while waiting for
-    a write to finish.'''
-    global last_write_time, delay_start
-    last_write_time = time.time()
-    delay_start = time.ticks_ms()
-
-def eeprom_delay():
-    ''' Wait here for at least 10ms to allow previous writes to finish.'''
-    global last_write_time, delay_start
-    if delay_start is None: return
-    if last_write_time is None: return
-    dsecs = time.time() - last_write_time
-    if dsecs > 2: return
-    while True:
-        dly = time.ticks_diff(time.ticks_ms(), delay_start) 
-        if dly > 10: return
-    delay_start = None
-    
+# I2C Bus
+# Everything that goes to the rtc or the eeprom goes through bus_read() and bus_write().
+# They use the readfrom_mem_into() and writeto_mem() calls, so the register or memory
+# address goes out in the same transaction as the data and nothing is copied, and they
+# count the transactions, bytes and time spent on each device.  See get_bus_stats().
+#
+# GP4/GP5 are the pins of the Pico's hardware I2C(0), which is used at 100 kHz, since the
+# AT24C32 on some modules is only rated for 100 kHz at 3.3 V.  On a board known to take it,
+# init_bus(freq=400_000) cuts the bus time to about a third.  init_bus(False) goes back to
+# SoftI2C, as the clock used to.
+
+RTC = 0              # Device numbers for the bus counters.
+EEPROM = 1
+bus_devices = (rtc_adr, eeprom_adr)
+BUS_NAMES = ("rtc", "eeprom")
+
+i2c = None
+bus_freq = 0
+bus_transactions = [0, 0]
+bus_bytes = [0, 0]
+bus_us = [0, 0]
+
+def init_bus(hardware=True, freq=100_000):
+    ''' Sets up the I2C bus, either the hardware I2C(0) or SoftI2C on the same pins.'''
+    global i2c, bus_freq
+    if hardware: i2c = I2C(0, scl=Pin(5), sda=Pin(4), freq=freq)
+    else:
+        if freq > 100_000: freq = 100_000
+        i2c = SoftI2C(Pin(5), Pin(4), freq=freq)
+    bus_freq = freq
+
+def bus_read(device, mem, buf, addrsize=8):
+    ''' Reads len(buf) bytes into buf, starting at a register or memory address of a device.'''
+    t0 = time.ticks_us()
+    i2c.readfrom_mem_into(bus_devices[device], mem, buf, addrsize=addrsize)
+    bus_count(device, len(buf), t0)
+
+def bus_write(device, mem, data, addrsize=8):
+    ''' Writes data to a device, starting at a register or memory address.'''
+    t0 = time.ticks_us()
+    i2c.writeto_mem(bus_devices[device], mem, data, addrsize=addrsize)
+    bus_count(device, len(data), t0)
+
+def bus_probe(device):
+    ''' Returns True if a device answers its address.  A one byte read is used, since
+    not every port can do a zero length write.'''
+    t0 = time.ticks_us()
+    try:
+        i2c.readfrom_into(bus_devices[device], probe_buf)
+        acked = True
+    except OSError:
+        acked = False
+    bus_count(device, 0, t0)
+    return acked
+
+probe_buf = bytearray(1)
+
+def bus_count(device, nbytes, t0):
+    bus_transactions[device] += 1
+    bus_bytes[device] += nbytes
+    bus_us[device] += time.ticks_diff(time.ticks_us(), t0)
+
+def get_bus_stats():
+    ''' Returns the bus counters as a dictionary, with one entry for each device.'''
+    stats = {"freq": bus_freq}
+    for i in range(len(BUS_NAMES)):
+        stats[BUS_NAMES[i]] = {"transactions": bus_transactions[i], "bytes": bus_bytes[i], "us": bus_us[i]}
+    return stats
+
+def reset_bus_stats():
+    for i in range(len(BUS_NAMES)):
+        bus_transactions[i] = 0
+        bus_bytes[i] = 0
+        bus_us[i] = 0
+
+init_bus()
+
+# EEPROM Write Cycle
+# After a write, the AT24C32 goes off on its own to program the page, and won't answer its
+# address until it is done (up to 10 ms, often less).  Instead of waiting a fixed time, a
+# write just notes that the chip is busy, and eeprom_ready() asks the chip if it is back
+# (ACK polling) without waiting.  Anything that has to use the chip waits with
+# wait_eeprom(), which polls until it answers.
+
+WRITE_TIMEOUT_MS = 20      # Give up polling after this long, and carry on.
+
+write_busy = False
+write_started = 0
+write_polls = 0
+write_timeouts = 0
+
+def eeprom_ready():
+    ''' Returns True if the eeprom has finished its last write.  Never waits.'''
+    global write_busy, write_polls, write_timeouts
+    if not write_busy: return True
+    write_polls += 1
+    if bus_probe(EEPROM): write_busy = False
+    elif time.ticks_diff(time.ticks_ms(), write_started) > WRITE_TIMEOUT_MS:
+        write_timeouts += 1
+        write_busy = False
+    return not write_busy
+
+def wait_eeprom():
+    ''' Waits for the eeprom to finish its last write.'''
+    while not eeprom_ready(): pass
+
+# EEPROM Cache
+# All 4K of the eeprom is kept in RAM.  It is read in one go the first time anything asks
+# for it, and after that reads come from RAM and never touch the bus.  Writes go into RAM
+# as well, and mark the 32 byte pages that they change as dirty.  The dirty pages are
+# written back FLUSH_DELAY_MS after the first change, one page at a time by flush_step()
+# from the main loop, so a burst of changes costs one write per page, and writing what is
+# already there costs nothing.  Pages are always written whole, so the page boundary rules
+# take care of themselves.  flush_step() never waits for the chip: if it is still busy with
+# the last page it just returns, and tries again next time.  wait_idle() writes everything
+# out and waits until the chip is done, for when the data has to be safe, like before a
+# reset.
+
+EEPROM_SIZE = 4096
+EEPROM_PAGE = 32
+EEPROM_PAGES = EEPROM_SIZE // EEPROM_PAGE
+FLUSH_DELAY_MS = 2000
+
+shadow = None              # The eeprom contents, once loaded.
+shadow_view = None
+dirty = bytearray(EEPROM_PAGES)
+dirty_count = 0
+flush_due = 0              # ticks_ms() at which the dirty pages should be written.
+flush_page = 0             # Where to start looking for the next dirty page.
+page_writes = 0
+
+def load_eeprom():
+    ''' Reads the whole eeprom into the cache, throwing away any unwritten changes.'''
+    global shadow, shadow_view, dirty_count
+    shadow = bytearray(EEPROM_SIZE)
+    shadow_view = memoryview(shadow)
+    bulk_read_eeprom(0, shadow_view)
+    for i in range(EEPROM_PAGES): dirty[i] = 0
+    dirty_count = 0
+
 def write_eeprom(addr, data):
-    ''' Writes bytes of data to the eeprom at the given address. Be
-    careful to obey page boundary and 32 byte rules.'''
-    eeprom_delay()
-    n = len(data)
-    outdata = bytearray(n + 2)
-    outdata[0]=addr >> 8   #MSB
-    outdata[1]=addr & 0xFF #LSB
-    for i in range(n): outdata[i + 2] = data[i]
-    i2c.writeto(eeprom_adr, outdata)
-    # Specs say a write might take 5 ms (per byte?) before the eeprom will
-    # respond to another request
-    start_eeprom_delay()
+    ''' Writes bytes of data to the eeprom at the given address.  The write goes to the
+    cache, and gets to the eeprom later.'''
+    global dirty_count, flush_due
+    if shadow is None: load_eeprom()
+    addr %= EEPROM_SIZE
+    end = addr + len(data)
+    a = addr
+    while a < end:
+        page = a // EEPROM_PAGE
+        b = min(end, (page + 1) * EEPROM_PAGE)
+        chunk = bytes(data[a - addr:b - addr])
+        if shadow[a:b] != chunk:
+            shadow[a:b] = chunk
+            if not dirty[page]:
+                if dirty_count == 0: flush_due = time.ticks_add(time.ticks_ms(), FLUSH_DELAY_MS)
+                dirty[page] = 1
+                dirty_count += 1
+        a = b
 
 def read_eeprom(addr, nbytes):
-    ''' Reads bytes of data from the eeprom at the given address'''
-    eeprom_delay()
-    addr_buf = bytearray(2)
-    addr_buf[0] = addr >> 8   #MSB
-    addr_buf[1] = addr & 0xFF #LSB
-    i2c.writeto(eeprom_adr, addr_buf)
-    x = i2c.readfrom(eeprom_adr, nbytes)
-    return x
+    ''' Reads bytes of data from the eeprom at the given address.  Wraps around at the
+    end of the eeprom, as the chip does.'''
+    if (addr % EEPROM_SIZE) + nbytes <= EEPROM_SIZE: return bytes(peek_eeprom(addr, nbytes))
+    buf = bytearray(nbytes)
+    read_eeprom_into(addr, buf)
+    return bytes(buf)
+
+def read_eeprom_into(addr, buf):
+    ''' Reads len(buf) bytes from the eeprom at the given address into buf, which can be
+    a memoryview.  Wraps around at the end of the eeprom.'''
+    if shadow is None: load_eeprom()
+    n = len(buf)
+    i = 0
+    while i < n:
+        a = (addr + i) % EEPROM_SIZE
+        k = min(n - i, EEPROM_SIZE - a)
+        buf[i:i + k] = shadow_view[a:a + k]
+        i += k
+
+def peek_eeprom(addr, nbytes):
+    ''' Returns a memoryview of the cache at the given address, without copying.  It
+    must not be written to, and changes when the eeprom is written.  It can't wrap, so
+    it stops at the end of the eeprom; use read_eeprom() for a range that goes past it.'''
+    if shadow is None: load_eeprom()
+    addr %= EEPROM_SIZE
+    return shadow_view[addr:addr + nbytes]
+
+def write_page(page):
+    ''' Writes one page of the cache out to the eeprom.'''
+    global dirty_count, page_writes, write_busy, write_started
+    wait_eeprom()
+    a = page * EEPROM_PAGE
+    bus_write(EEPROM, a, shadow_view[a:a + EEPROM_PAGE], addrsize=16)
+    write_busy = True
+    write_started = time.ticks_ms()
+    dirty[page] = 0
+    dirty_count -= 1
+    page_writes += 1
+
+def next_dirty_page():
+    global flush_page
+    for i in range(EEPROM_PAGES):
+        page = (flush_page + i) % EEPROM_PAGES
+        if dirty[page]:
+            flush_page = page + 1
+            return page
+    return -1
+
+def flush_step():
+    ''' Writes one dirty page if they are due and the eeprom is ready for it.  Returns
+    True if it wrote one.'''
+    if dirty_count == 0 or time.ticks_diff(time.ticks_ms(), flush_due) < 0: return False
+    if not eeprom_ready(): return False
+    write_page(next_dirty_page())
+    return True
+
+def wait_idle():
+    ''' Writes all the dirty pages now, and waits until the eeprom has them.'''
+    while dirty_count > 0: write_page(next_dirty_page())
+    wait_eeprom()
+
+def get_eeprom_stats():
+    return {"loaded": shadow is not None, "dirty_pages": dirty_count, "page_writes": page_writes,
+            "write_polls": write_polls, "write_timeouts": write_timeouts}
     
-def dump_eeprom(a0, n):
-    dump = ""
+# Bulk Reads
+# The AT24C32 keeps counting through its pages on a read, so any range can be read in one
+# transaction.  bulk_read_eeprom() goes straight to the chip, in BULK_CHUNK byte pieces so
+# that the bus is never held long enough to hold up the display timer (256 bytes is about
+# 6 ms at 400 kHz).  It is how the cache gets loaded; everything else reads the cache.
+# dump_lines() makes the dump a line at a time, so a web page can send it as it goes.
+
+BULK_CHUNK = 256
+
+def bulk_read_eeprom(addr, buf, chunk=BULK_CHUNK):
+    ''' Reads len(buf) bytes from the eeprom chip at the given address into buf, which
+    can be a memoryview, in as few transactions as chunk allows.  Wraps around at the end
+    of the eeprom.'''
+    view = memoryview(buf)
+    wait_eeprom()
+    i = 0
+    while i < len(view):
+        a = (addr + i) % EEPROM_SIZE
+        n = min(chunk, len(view) - i, EEPROM_SIZE - a)
+        bus_read(EEPROM, a, view[i:i + n], addrsize=16)
+        i += n
+
+dump_chars = "".join(["." if b == 0 else chr(b) if b >= 32 and b < 127 else "-" for b in range(256)])
+
+def dump_lines(a0, n):
+    ''' Yields the dump of the eeprom from a0, 64 bytes to a line.'''
     nrows = int((n / 64) + 1)
+    x = bytearray(64)
     for i in range(nrows):
         a = i * 64 + a0
-        ss = "%04d: " % a
-        for j in range(2):
-            x = read_eeprom(a + j * 32, 32)
-            sx = ""
-            for ii in range(32):
-                if x[ii] >= 32 and x[ii] < 127: sx += chr(x[ii])
-                elif x[ii] != 0: sx += '-'
-                else: sx += '.'
-            ss += sx
-        print(ss)
-        dump +=ss + "\n"
+        read_eeprom_into(a, x)
+        yield "%04d: " % a + "".join([dump_chars[b] for b in x]) + "\n"
+
+def dump_eeprom(a0, n):
+    dump = ""
+    for ss in dump_lines(a0, n):
+        print(ss, end="")
+        dump += ss
     return dump
         
         
+rtc_buf = bytearray(7)     # The time registers, for get_time() and set_time().
+reg_buf = bytearray(1)
+
 def get_time():
     ''' Returns time as a 8-tuple: year, month, day, hour, min, sec, wday, doy.
     Uses 24 hour format.  Should be UTC time!  wday and doy should be ignored.'''
-    raw = i2c.readfrom_mem(rtc_adr, 0, 7)
+    raw = rtc_buf
+    bus_read(RTC, 0, raw)
     secs = (((raw[0] >> 4) & 0x0F) * 10) + (raw[0] & 0x0F)
     mins = (((raw[1] >> 4) & 0x0F) * 10) + (raw[1] & 0x0F)
     is12 = ((raw[2] & 0x40) != 0)
@@ -121,7 +332,7 @@ def set_time(t):
     Uses 24 hour format.  Time should be given in UTC!  dow and doy ignored.'''
     year, month, date, hours, mins, secs, wday, doy = t
     dow = th.day_of_week(t)
-    data = bytearray(7)
+    data = rtc_buf
     data[0] = bcd(secs)
     data[1] = bcd(mins)
     data[2] = bcd(hours)
@@ -129,13 +340,209 @@ def set_time(t):
     data[4] = bcd(date)
     data[5] = bcd(month)
     data[6] = bcd(year - 2000)
-    i2c.writeto_mem(rtc_adr, 0, data)
-    
+    bus_write(RTC, 0, data)
+    anchor(civil.seconds(t), time.ticks_ms())
+
+# Anchored Time
+# Reading the DS3231 takes a 7 byte I2C transaction, too much for every display tick.  So
+# the clock is read now and then, and tied to time.ticks_ms() with an anchor: the tick
+# count at which a given UTC second started.  utc_now() works the time out from the anchor
+# and never touches the bus.
+#
+# sync() keeps the anchor honest.  It is called from the main loop, so that all I2C stays
+# out of the display timer.  Every RESYNC_MS it checks the anchor with two reads of the
+# DS3231, one a little before and one a little after a second that the anchor predicts.  If
+# either one is off, the ticks have drifted (or someone changed the time), so it searches
+# for where the DS3231's second really changes, reading it every time it is called until it
+# sees the change, and re-anchors there.  If the time has jumped by more than a second, the
+# new time is used right away, before the search finishes.  A check that passes moves the
+# anchor up to the second it checked, since ticks_diff() only works for ticks less than
+# 2**29 ms (about 6 days) apart.  set_time() re-anchors by itself, since writing the seconds
+# register restarts the DS3231's second.
 
+RESYNC_MS = 60000    # How often to check the anchor.
+CHECK_MS = 30        # The check passes if the anchor is off by less than this.
+SEARCH_GAP_MS = 50   # Reads can't be further apart than this to pin down a change.
 
-    
-    
-    
-    
-    
-    
\ No newline at end of file
+SYNCED = 0
+CHECK = 1
+SEARCH = 2
+
+anchor_secs = None   # UTC seconds...
+anchor_ticks = 0     # ...that started at this ticks_ms().
+sync_state = SEARCH
+synced_at = 0        # ticks_ms() of the last good check.
+check_before = False # Passed the read just before the second, waiting for the one after.
+search_secs = None   # Last reading while searching, and when it was taken.
+search_ticks = 0
+rtc_reads = 0
+corrections = 0
+
+def anchor(secs, ticks):
+    global anchor_secs, anchor_ticks, sync_state, synced_at, search_secs
+    anchor_secs = secs
+    anchor_ticks = ticks
+    sync_state = SYNCED
+    synced_at = ticks
+    search_secs = None
+
+def read_utc():
+    ''' Reads the DS3231, and returns UTC seconds.'''
+    global rtc_reads
+    rtc_reads += 1
+    return civil.seconds(get_time())
+
+def utc_now():
+    ''' Returns the current UTC time in seconds.  Only reads the DS3231 if there is no
+    anchor yet.'''
+    now = time.ticks_ms()
+    if anchor_secs is None: start_anchor(now)
+    return anchor_secs + time.ticks_diff(now, anchor_ticks) // 1000
+
+def second_start(now):
+    ''' Returns the ticks_ms() at which the current second started.'''
+    return time.ticks_add(now, -(time.ticks_diff(now, anchor_ticks) % 1000))
+
+def start_anchor(now=None):
+    ''' Anchors on one reading of the DS3231.  That can be up to a second off, so a search
+    follows to line it up with the real start of a second.'''
+    global sync_state, search_secs, search_ticks
+    if now is None: now = time.ticks_ms()
+    anchor(read_utc(), now)
+    sync_state = SEARCH
+    search_secs = anchor_secs
+    search_ticks = now
+
+def sync():
+    ''' Does the next step of keeping the anchor in line with the DS3231.  Call it often,
+    from the main loop.'''
+    global anchor_secs, sync_state, synced_at, check_before, search_secs, search_ticks, corrections
+    now = time.ticks_ms()
+    if anchor_secs is None:
+        start_anchor(now)
+        return
+    if sync_state == SYNCED:
+        if time.ticks_diff(now, synced_at) < RESYNC_MS: return
+        sync_state = CHECK
+        check_before = False
+    elapsed = time.ticks_diff(now, anchor_ticks)
+    predicted = anchor_secs + elapsed // 1000
+    into = elapsed % 1000
+    if sqw_running(now):
+        # The square wave keeps the anchor on the start of each second, so only the count
+        # needs checking, with one read well away from the edges.
+        if into < 300 or into >= 700: return
+        secs = read_utc()
+        if secs != predicted:
+            anchor_secs += secs - predicted
+            if sync_state == CHECK: corrections += 1
+        sync_state = SYNCED
+        synced_at = now
+        return
+    if sync_state == CHECK:
+        if into >= 1000 - 2 * CHECK_MS and into < 1000 - CHECK_MS:
+            secs = read_utc()
+            check_before = secs == predicted
+            if not check_before: sync_state = SEARCH
+        elif into >= CHECK_MS and into < 2 * CHECK_MS:
+            if not check_before: return
+            secs = read_utc()
+            if secs == predicted:
+                # Move the anchor up to this second, so it never gets old enough for
+                # ticks_diff() to wrap.
+                anchor(predicted, time.ticks_add(anchor_ticks, elapsed - into))
+                return
+            sync_state = SEARCH
+        else:
+            if into >= 2 * CHECK_MS and into < 1000 - 2 * CHECK_MS: check_before = False
+            return
+        if sync_state != SEARCH: return
+        corrections += 1
+        search_secs = secs
+        search_ticks = now
+    else:
+        secs = read_utc()
+        if search_secs is not None and secs != search_secs and time.ticks_diff(now, search_ticks) <= SEARCH_GAP_MS:
+            # Caught the second changing, somewhere since the last reading.
+            anchor(secs, time.ticks_add(search_ticks, time.ticks_diff(now, search_ticks) // 2))
+            return
+        search_secs = secs
+        search_ticks = now
+    if abs(secs - predicted) >= 2:
+        # The time jumped.  Use it now, and keep searching for the start of the second.
+        anchor(secs, now)
+        sync_state = SEARCH
+        search_secs = secs
+        search_ticks = now
+
+def get_sync_stats():
+    ''' Returns the anchored time counters as a dictionary.'''
+    return {"state": ("synced", "checking", "searching")[sync_state], "reads": rtc_reads, "corrections": corrections, "edges": sqw_edges}
+
+# Square Wave
+# The DS3231 can put out a 1 Hz square wave on its SQW/INT pin, and its seconds register
+# counts up on the falling edge.  With that pin wired to SQW_PIN (it is open drain, so the
+# pull up is needed), start_sqw() sets the chip up for 1 Hz and timestamps every falling
+# edge.  Each edge moves the anchor onto the start of the second, so the ticks can't drift
+# away from the rtc, and sync() only has to check the count of seconds now and then.  If
+# on_second is set, it is called with the ticks_ms() of each edge, which main uses to draw
+# the display right as the second changes.  If no edges come in (the pin isn't wired),
+# sqw_running() stays False and the anchor is kept in line by reading the rtc as before.
+#
+# simulate_sqw() fakes the edges with a timer, lined up with the anchor, to try all this
+# out without the pin wired.  On a PC, sqw_edge() can just be called at the right times.
+
+SQW_PIN = 6
+SQW_TIMEOUT_MS = 1500   # No edge for this long means the square wave isn't there.
+REG_CONTROL = 0x0E
+INTCN = 0x04            # Control register bits: alarm interrupts instead of the square wave,
+RS_BITS = 0x18          # and the square wave rate (00 = 1 Hz).
+
+sqw_pin = None
+sqw_timer = None
+sqw_ticks = 0           # ticks_ms() of the last edge.
+sqw_edges = 0
+on_second = None
+
+def start_sqw(pin=SQW_PIN):
+    ''' Turns on the 1 Hz square wave and starts timestamping its edges.'''
+    global sqw_pin
+    bus_read(RTC, REG_CONTROL, reg_buf)
+    reg_buf[0] &= ~(INTCN | RS_BITS)
+    bus_write(RTC, REG_CONTROL, reg_buf)
+    sqw_pin = Pin(pin, Pin.IN, Pin.PULL_UP)
+    sqw_pin.irq(trigger=Pin.IRQ_FALLING, handler=sqw_edge)
+
+def stop_sqw():
+    global sqw_pin, sqw_timer
+    if sqw_pin is not None: sqw_pin.irq(handler=None)
+    if sqw_timer is not None: sqw_timer.deinit()
+    sqw_pin = None
+    sqw_timer = None
+
+def sqw_edge(pin):
+    ''' Handles an edge of the square wave: a new second starts now.'''
+    global anchor_secs, anchor_ticks, sqw_ticks, sqw_edges
+    now = time.ticks_ms()
+    if anchor_secs is not None:
+        anchor_secs += (time.ticks_diff(now, anchor_ticks) + 500) // 1000
+        anchor_ticks = now
+    sqw_ticks = now
+    sqw_edges += 1
+    if on_second is not None: on_second(now)
+
+def sqw_running(now):
+    return sqw_edges > 0 and time.ticks_diff(now, sqw_ticks) < SQW_TIMEOUT_MS
+
+def simulate_sqw():
+    ''' Fakes the square wave with a timer, starting at the next second of the anchor.'''
+    global sqw_timer
+    stop_sqw()
+    now = time.ticks_ms()
+    if anchor_secs is None: start_anchor(now)
+    sqw_timer = Timer()
+    sqw_timer.init(period=1000 - time.ticks_diff(now, second_start(now)), mode=Timer.ONE_SHOT, callback=simulated_first_edge)
+
+def simulated_first_edge(timer):
+    timer.init(period=1000, mode=Timer.PERIODIC, callback=sqw_edge)
+    sqw_edge(None)
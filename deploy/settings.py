@@ -0,0 +1,99 @@
+# settings.py -- Deferred saving of the clock settings
+
+# The live settings are kept in main's globals.  When one changes, main hands the new
+# value to change(), which only notes it.  commit_step() runs from the main loop and writes
+# the changed settings to the eeprom once nothing has changed for QUIET_MS, or MAX_WAIT_MS
+# after the first unsaved change if they keep changing.  So sliding the brightness on the
+# web page, or spinning the encoder, ends up as one write of each setting that changed,
+# and a setting that was put back where it was isn't written at all.  Writes go through
+# history, into the eeprom cache (see rtcmod).
+
+import time
+import history as hist
+
+QUIET_MS = 2000        # Save once the settings have been left alone this long,
+MAX_WAIT_MS = 10000    # but don't hold an unsaved change longer than this.
+
+COLOR_SLOTS = ("digit_color", "colon_color", "seconds_color", "am_color")
+
+values = {}            # Latest value of each setting.
+saved = {}             # Value of each setting in the eeprom.
+pending = 0            # Number of settings that differ from the eeprom.
+first_change = 0       # ticks_ms() of the first and last unsaved changes.
+last_change = 0
+
+changes = 0
+commits = 0
+field_writes = 0
+
+def load(name, value):
+    ''' Notes a setting's value as read from the eeprom.'''
+    values[name] = value
+    saved[name] = value
+
+def change(name, value):
+    ''' Changes a setting.  It gets saved later by commit_step().'''
+    global pending, first_change, last_change, changes
+    old = values.get(name)
+    values[name] = value
+    if value == old: return
+    changes += 1
+    now = time.ticks_ms()
+    if pending == 0: first_change = now
+    last_change = now
+    pending = count_pending()
+
+def get(name, default=None):
+    return values.get(name, default)
+
+def count_pending():
+    n = 0
+    for name in values:
+        if name not in saved or values[name] != saved[name]: n += 1
+    return n
+
+def commit_step():
+    ''' Saves the changed settings if they have been quiet long enough, or have waited too
+    long.  Returns True if it saved anything.'''
+    if pending == 0: return False
+    now = time.ticks_ms()
+    if time.ticks_diff(now, last_change) < QUIET_MS and time.ticks_diff(now, first_change) < MAX_WAIT_MS: return False
+    commit()
+    return True
+
+def commit():
+    ''' Saves the changed settings now.'''
+    global pending, commits, field_writes
+    if pending == 0: return
+    colors_changed = False
+    for name in values:
+        value = values[name]
+        if name in saved and saved[name] == value: continue
+        if name in COLOR_SLOTS: colors_changed = True
+        else: write(name, value)
+        saved[name] = value
+        field_writes += 1
+    if colors_changed: write_colors()
+    pending = 0
+    commits += 1
+
+def write_colors():
+    ''' Writes the four colors as one record, however many of them changed.'''
+    old = hist.read_colors()
+    colors = []
+    for i in range(len(COLOR_SLOTS)):
+        if COLOR_SLOTS[i] in values: colors += values[COLOR_SLOTS[i]]
+        else: colors += old[2 * i:2 * i + 2]
+    hist.write_colors(*colors)
+
+def write(name, value):
+    if name == "brightness":
+        hist.write_brightness(value)
+        hist.log_event(hist.EV_BRIGHTNESS, int(value * 1000))
+    elif name == "render_style": hist.write_render_style(value)
+    elif name == "timezone": hist.write_timezone(value)
+    else: raise ValueError("unknown setting: " + name)
+
+def get_stats():
+    ''' Returns the settings counters as a dictionary.'''
+    return {"changes": changes, "commits": commits, "field_writes": field_writes, "pending": pending}
@@ -11,21 +11,14 @@
 # micropython to be zero, so we must stick with that.  
 
 import time
+import civil
 
 pst_offset = -8 * 3600    # PST -- Pacific Standard Time is used between Nov and Mar
 pdt_offset = -7 * 3600    # PDT -- Pacific Daylight Time is used between Mar and Nov
 
 def day_of_week(t):
     ''' Calculates the day-of-week (0=Monday) from a time 8-tuple.'''
-    # Note: 1/1/1996 was a Monday.  Monday = 0, Sunday=6.
-    tref = (1996, 1, 1, 0, 0, 0, 0, 0)  # Our reference Monday.
-    y, mth, day, h, m, s, wd, doy = t
-    tchk = (y, mth, day, h, m, s, 0, 0)
-    tdif_secs = time.mktime(tchk) - time.mktime(tref)
-    ndays = int(tdif_secs / (24*60*60))
-    nweeks = int(ndays / 7)
-    wday = ndays - (nweeks * 7)
-    return int(wday)
+    return civil.weekday_of(t[0], t[1], t[2])
 
 def daylight_savings_check(t):
     ''' Returns True if time is in daylight savings. Input time should be local time
@@ -33,7 +26,7 @@ def daylight_savings_check(t):
     years, month, date, hour, mins, secs, _, _ = t
     dow = day_of_week(t)
     if month < 3 or month > 11: return False    # Dec, Jan, Feb are Standard Time
-    if month > 3 or month < 11: return True     # Apr, May, Jun, July, Aug, Sept, Oct are Daylight Savgins
+    if month > 3 and month < 11: return True    # Apr, May, Jun, July, Aug, Sept, Oct are Daylight Savgins
     # Its only March and November that are special cases
     dx = dow + 1       # Renumber weekdays so that Sunday is zero
     if dx > 6: dx = 0
@@ -48,20 +41,206 @@ def daylight_savings_check(t):
             return False
         return False
     # Its November. Standard time starts on the first Sunday...
-    if date_of_previous_sunday < 0: return True
+    if date_of_previous_sunday < 1: return True
     if date > date_of_previous_sunday: return False
     # Its the day of change! Standard time starts at 2 am...
     if hour < 2: return True
     return False
 
+# Time Zones
+# The time zone is given as a POSIX TZ string, for example "PST8PDT,M3.2.0,M11.1.0":
+#   std offset [dst [offset] [,start[/time],end[/time]]]
+# The offsets count hours west of UTC (so PST is 8), and dst defaults to one hour ahead of
+# std.  start and end are when daylight time starts and ends, in local time, as one of:
+#   Mm.w.d  day d (0=Sunday) of week w (1-4, or 5 for the last) of month m
+#   Jn      day n of the year (1-365), never counting Feb 29
+#   n       day n of the year (0-365), counting Feb 29
+# /time defaults to 02:00:00.  A zone with dst but no rule uses the US rules.
+#
+# A Zone works out the UTC instants when its clocks change for a few years around the
+# time asked about, and keeps them in a sorted table.  Finding the offset to local time is
+# then a binary search on that table, and only falls back to the calendar when time moves
+# past the end of the table.
+
+DEFAULT_TZ = "PST8PDT,M3.2.0,M11.1.0"
+WINDOW_YEARS = 2    # Years compiled ahead of the one asked about (one behind as well).
+
+class Zone:
+    def __init__(self, tz):
+        ''' Compiles a POSIX TZ string.  Raises ValueError if it can't be read.'''
+        self.tz = tz
+        self.std_name, i = parse_tz_name(tz, 0)
+        offset, i = parse_tz_time(tz, i)
+        self.std_offset = -offset
+        self.dst_offset = self.std_offset
+        self.rules = None
+        self.times = []       # UTC instants of the changes, in order.
+        self.offsets = []     # Offset that takes effect at each change.
+        self.t0 = self.t1 = 0 # UTC range that the table covers.
+        if i == len(tz): return
+        self.dst_name, i = parse_tz_name(tz, i)
+        self.dst_offset = self.std_offset + 3600
+        if i < len(tz) and tz[i] != ',':
+            offset, i = parse_tz_time(tz, i)
+            self.dst_offset = -offset
+        if i == len(tz): tz += ",M3.2.0,M11.1.0"
+        if tz[i] != ',': raise ValueError("bad time zone: " + self.tz)
+        start, i = parse_tz_rule(tz, i + 1)
+        if i >= len(tz) or tz[i] != ',': raise ValueError("bad time zone: " + self.tz)
+        end, i = parse_tz_rule(tz, i + 1)
+        if i != len(tz): raise ValueError("bad time zone: " + self.tz)
+        self.rules = (start, end)
+
+    def compile(self, year):
+        ''' Builds the table of changes for the years around year.'''
+        changes = []
+        for y in range(year - 1, year + WINDOW_YEARS + 1):
+            changes.append((rule_time(self.rules[0], y) - self.std_offset, self.dst_offset))
+            changes.append((rule_time(self.rules[1], y) - self.dst_offset, self.std_offset))
+        changes.sort()
+        self.times = [c[0] for c in changes]
+        self.offsets = [c[1] for c in changes]
+        self.t0 = civil.days(year - 1, 1, 1) * 86400
+        self.t1 = civil.days(year + WINDOW_YEARS + 1, 1, 1) * 86400
+
+    def utc_offset(self, tutc):
+        ''' Returns the offset from UTC to local time at tutc (UTC seconds).'''
+        if self.rules is None: return self.std_offset
+        if tutc < self.t0 or tutc >= self.t1: self.compile(civil.to_tuple(tutc)[0])
+        times = self.times
+        lo = 0
+        hi = len(times)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if times[mid] <= tutc: lo = mid + 1
+            else: hi = mid
+        if lo == 0:
+            # Before the first change in the table, so the other offset is in effect.
+            if self.offsets[0] == self.dst_offset: return self.std_offset
+            return self.dst_offset
+        return self.offsets[lo - 1]
+
+def parse_tz_name(tz, i):
+    ''' Reads a zone name, either letters or <quoted>.  Returns (name, next index).  A
+    quoted name can only have letters, digits, + and -.'''
+    if i < len(tz) and tz[i] == '<':
+        j = i + 1
+        while j < len(tz) and (tz[j].isalpha() or tz[j].isdigit() or tz[j] in "+-"): j += 1
+        if j >= len(tz) or tz[j] != '>' or j - i - 1 < 3: raise ValueError("bad time zone: " + tz)
+        return tz[i + 1:j], j + 1
+    j = i
+    while j < len(tz) and tz[j].isalpha(): j += 1
+    if j - i < 3: raise ValueError("bad time zone: " + tz)
+    return tz[i:j], j
+
+def parse_tz_number(tz, i):
+    j = i
+    while j < len(tz) and tz[j].isdigit(): j += 1
+    if j == i: raise ValueError("bad time zone: " + tz)
+    return int(tz[i:j]), j
+
+def parse_tz_time(tz, i):
+    ''' Reads [+-]hh[:mm[:ss]] as seconds.  Returns (seconds, next index).'''
+    sign = 1
+    if i < len(tz) and tz[i] in "+-":
+        if tz[i] == '-': sign = -1
+        i += 1
+    secs, i = parse_tz_number(tz, i)
+    secs *= 3600
+    for scale in (60, 1):
+        if i >= len(tz) or tz[i] != ':': break
+        n, i = parse_tz_number(tz, i + 1)
+        secs += n * scale
+    return sign * secs, i
+
+def parse_tz_rule(tz, i):
+    ''' Reads a start or end rule.  Returns ((kind, a, b, c, seconds), next index).'''
+    if i < len(tz) and tz[i] == 'M':
+        month, i = parse_tz_number(tz, i + 1)
+        if i >= len(tz) or tz[i] != '.': raise ValueError("bad time zone: " + tz)
+        week, i = parse_tz_number(tz, i + 1)
+        if i >= len(tz) or tz[i] != '.': raise ValueError("bad time zone: " + tz)
+        day, i = parse_tz_number(tz, i + 1)
+        if month < 1 or month > 12 or week < 1 or week > 5 or day > 6: raise ValueError("bad time zone: " + tz)
+        rule = ['M', month, week, day]
+    elif i < len(tz) and tz[i] == 'J':
+        n, i = parse_tz_number(tz, i + 1)
+        if n < 1 or n > 365: raise ValueError("bad time zone: " + tz)
+        rule = ['J', n, 0, 0]
+    else:
+        n, i = parse_tz_number(tz, i)
+        if n > 365: raise ValueError("bad time zone: " + tz)
+        rule = ['N', n, 0, 0]
+    secs = 2 * 3600
+    if i < len(tz) and tz[i] == '/': secs, i = parse_tz_time(tz, i + 1)
+    rule.append(secs)
+    return tuple(rule), i
+
+def rule_time(rule, year):
+    ''' Returns the local time in seconds given by a rule in a year.'''
+    kind, a, b, c, secs = rule
+    if kind == 'M':
+        dow = (civil.weekday_of(year, a, 1) + 1) % 7     # Renumber weekdays so that Sunday is zero
+        days = civil.days_in_month(year, a)
+        day = 1 + (c - dow) % 7 + (b - 1) * 7
+        while day > days: day -= 7
+        return civil.days(year, a, day) * 86400 + secs
+    if kind == 'J':
+        n = a - 1
+        if civil.is_leap(year) and a >= 60: n += 1
+    else: n = a
+    return (civil.days(year, 1, 1) + n) * 86400 + secs
+
+zone = Zone(DEFAULT_TZ)
+
+def set_timezone(tz):
+    ''' Switches to a new time zone.  Raises ValueError if the TZ string can't be read.'''
+    global zone
+    zone = Zone(tz)
+
+def get_timezone():
+    return zone.tz
+
+def utc_offset(tutc):
+    ''' Returns the offset from UTC to local time at tutc (UTC seconds).'''
+    return zone.utc_offset(tutc)
+
+# Local time in seconds can be split up without the calendar:
+#   hour = t // 3600 % 24,  minute = t // 60 % 60,  second = t % 60
+
+def weekday(t):
+    ''' Returns the day-of-week (0=Monday) of a time in seconds.'''
+    return civil.weekday(t // 86400)
+
+def check_dst_table(first_year=2020, last_year=2100):
+    ''' Checks the default zone against daylight_savings_check() at noon on every day from
+    first_year to last_year, and on both sides of every change.  Returns the number of
+    mismatches.  The hour after the fall change (1 am twice) is skipped, since a local
+    time can't tell which one it is.'''
+    pacific = Zone(DEFAULT_TZ)
+    bad = 0
+    for year in range(first_year, last_year + 1):
+        pacific.compile(year)
+        start = pacific.times[2]   # The table starts with the year before.
+        end = pacific.times[3]
+        checks = [start - 1, start, end - 1, end + 3600]
+        day = civil.seconds((year, 1, 1, 20, 0, 0))   # Noon, or 1 pm in daylight time
+        while civil.to_tuple(day)[0] == year:
+            checks.append(day)
+            day += 24 * 3600
+        for tutc in checks:
+            offset = pacific.utc_offset(tutc)
+            tlocal = civil.to_tuple(tutc + offset)
+            if daylight_savings_check(tlocal) != (offset == pdt_offset):
+                print("DST mismatch at", tlocal)
+                bad += 1
+    return bad
+
 def apply_offset(t, offset):
     ''' Returns a time with the offset in seconds applied.  Used
     to calculate local time. Input is an 8-tuple, with wday and doy
     ignored. '''
-    unix_time = time.mktime(t)
-    unix_time += offset
-    tt = time.localtime(unix_time)
-    return tt
+    return civil.to_tuple(civil.seconds(t) + offset)
 
 def h24_to_h12(hours):
     ''' Converts 24 hour format into 12 hour format. '''
@@ -57,6 +57,7 @@ def sync_time(tnow, override=False):
             sync_mode = SYNC_OFF
         return
     if sync_mode == SYNC_NTP:
+        t0 = time.ticks_ms()
         t = ntp.ntp()
         if t is None:
             if time.time() - tmark > 60.0:
@@ -66,8 +67,10 @@ def sync_time(tnow, override=False):
             return
         str_tme = str(time.localtime(t))
         print("Setting Clock to UTC Time: %s" % str_tme)
+        latency = time.ticks_diff(time.ticks_ms(), t0)
+        offset = rtc.utc_now() - t
         rtc.set_time(time.localtime(t))
-        hist.time_check(t)
+        hist.time_check(t, offset, latency)
         ntp.network_off()
         sync_mode = SYNC_OFF
         return
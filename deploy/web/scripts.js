@@ -177,6 +177,23 @@ function sendMessage() {
         xhr.send();
     }
 
+    function setTimeZone() {
+        var tz = document.getElementById("timeZoneText").value;
+        var xhr = new XMLHttpRequest();
+        xhr.open("POST", "/set_timezone?tz=" + encodeURIComponent(tz), true);
+        xhr.setRequestHeader("Content-type", "application/x-www-form-urlencoded");
+        showLoading(true);
+
+        xhr.onreadystatechange = function() {
+            if (xhr.readyState == 4){
+                showLoading(false);
+                document.getElementById("timeZoneResult").innerText = xhr.responseText;
+            }
+        };
+
+        xhr.send();
+    }
+
     function getTimeCheckRecords() {
         var xhr = new XMLHttpRequest();
         xhr.open("POST", "/get_time_check_records", true);